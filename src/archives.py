@@ -0,0 +1,193 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Index of the .deb files in APT's download cache.
+
+One os.scandir() pass over /var/cache/apt/archives parses every
+name_version_arch.deb file name. The versions of each package are
+ordered with apt_pkg.version_compare, so 1.10 is rightly newer than
+1.9, and the index is reused until the directory changes."""
+
+import collections
+import functools
+import os
+import re
+import urllib.parse
+
+import apt_pkg
+
+import util
+
+CachedDeb = collections.namedtuple(
+    "CachedDeb", "name version arch path size atime mtime"
+)
+
+_index_cache = dict()
+
+
+def archives_dir():
+    """Return the download cache directory, following any --root"""
+    return apt_pkg.config.find_dir("Dir::Cache::archives")
+
+
+def parse_filename(filename):
+    """Split name_version_arch.deb into its parts, or return None"""
+    if not filename.endswith(".deb"):
+        return None
+    parts = filename[:-len(".deb")].split("_")
+    if len(parts) != 3:
+        return None
+    name, version, arch = parts
+    # APT escapes the epoch colon of the version as %3a.
+    return name, urllib.parse.unquote(version), arch
+
+
+def index():
+    """Return a dict of package name to its cached debs, newest first"""
+    directory = archives_dir()
+    key = util.file_fingerprint(directory)
+    if key in _index_cache:
+        return _index_cache[key]
+    packages = collections.defaultdict(list)
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        entries = []
+    for entry in entries:
+        parsed = parse_filename(entry.name)
+        if parsed is None or not entry.is_file():
+            continue
+        info = entry.stat()
+        packages[parsed[0]].append(CachedDeb(
+            parsed[0], parsed[1], parsed[2], entry.path,
+            info.st_size, info.st_atime, info.st_mtime,
+        ))
+    newest_first = functools.cmp_to_key(
+        lambda a, b: apt_pkg.version_compare(b.version, a.version)
+    )
+    for debs in packages.values():
+        debs.sort(key=newest_first)
+    _index_cache.clear()
+    _index_cache[key] = dict(packages)
+    return _index_cache[key]
+
+
+def newest(name, arch=None):
+    """Return the newest cached deb of a package, or None"""
+    for deb in index().get(name, []):
+        if arch is None or deb.arch in (arch, "all"):
+            return deb
+    return None
+
+
+def find(name, version, arch=None):
+    """Return the cached deb of an exact package version, or None"""
+    for deb in index().get(name, []):
+        if deb.version == version and (arch is None or
+                                       deb.arch in (arch, "all")):
+            return deb
+    return None
+
+
+def lookup(cache, deb):
+    """Return the apt package a cached deb belongs to, or None"""
+    name = deb.name
+    if deb.arch != "all" and deb.arch != apt_pkg.get_architectures()[0]:
+        name = "{}:{}".format(deb.name, deb.arch)
+    try:
+        return cache[name]
+    except KeyError:
+        return None
+
+
+def usage(pattern=None):
+    """Yield a usage summary of the cached debs of each package
+
+    Each summary is a dict holding the package name, its installed and
+    candidate versions, and the number and bytes of its files: in all,
+    of stale versions (older than both the installed and the candidate
+    version) and of versions 'apt-get autoclean' would delete because
+    no source offers them any more."""
+    regex = re.compile(pattern) if pattern else None
+    cache = util.get_cache()
+    packages = index()
+    for name in sorted(packages):
+        debs = packages[name]
+        if regex:
+            debs = [deb for deb in debs
+                    if regex.search(os.path.basename(deb.path))]
+            if not debs:
+                continue
+        summary = dict(package=name, installed=None, candidate=None,
+                       files=0, bytes=0, stale_files=0, stale_bytes=0,
+                       autoclean_files=0, autoclean_bytes=0)
+        known = dict()
+        for deb in debs:
+            if deb.arch not in known:
+                package = lookup(cache, deb)
+                current = list()
+                downloadable = set()
+                if package is not None:
+                    if package.installed:
+                        summary["installed"] = package.installed.version
+                        current.append(package.installed.version)
+                    if package.candidate:
+                        summary["candidate"] = package.candidate.version
+                        current.append(package.candidate.version)
+                    downloadable = {version.version for version in
+                                    package.versions if version.downloadable}
+                known[deb.arch] = current, downloadable
+            current, downloadable = known[deb.arch]
+            summary["files"] += 1
+            summary["bytes"] += deb.size
+            # With neither an installed nor a candidate version there
+            # is nothing to be older than.
+            if current and all(apt_pkg.version_compare(deb.version, v) < 0
+                               for v in current):
+                summary["stale_files"] += 1
+                summary["stale_bytes"] += deb.size
+            if deb.version not in downloadable:
+                summary["autoclean_files"] += 1
+                summary["autoclean_bytes"] += deb.size
+        yield summary
+
+
+def prune_plan(keep=2, budget=None):
+    """Decide which cached debs to delete, returning (deb, reason) pairs
+
+    Of each package and architecture only the KEEP newest versions are
+    kept, together with the installed and candidate versions whatever
+    their age. If the kept files still exceed BUDGET bytes, the least
+    recently used of them that are neither installed nor candidates are
+    evicted too, until the cache fits."""
+    cache = util.get_cache()
+    doomed = list()
+    evictable = list()
+    remaining = 0
+    for name, debs in index().items():
+        by_arch = collections.defaultdict(list)
+        for deb in debs:
+            by_arch[deb.arch].append(deb)
+        for arch, versions in by_arch.items():
+            package = lookup(cache, versions[0])
+            protected = set()
+            if package is not None:
+                for version in (package.installed, package.candidate):
+                    if version is not None:
+                        protected.add(version.version)
+            # The versions are ordered newest first.
+            for position, deb in enumerate(versions):
+                if deb.version in protected:
+                    remaining += deb.size
+                elif position < keep:
+                    remaining += deb.size
+                    evictable.append(deb)
+                else:
+                    doomed.append((deb, "older than {} newest".format(keep)))
+    if budget is not None:
+        evictable.sort(key=lambda deb: deb.atime)
+        for deb in evictable:
+            if remaining <= budget:
+                break
+            doomed.append((deb, "least recently used"))
+            remaining -= deb.size
+    return doomed, remaining
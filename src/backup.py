@@ -0,0 +1,156 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Back up installed packages before they are upgraded.
+
+Backups are kept in ~/.wajig/<hostname>/backups. Each run gets a dated
+directory, like backups/2010-09-21_09h21, of name_version_arch.deb
+files which are hard links into a store of debs named by their sha256,
+backups/store, so a version saved on several dates takes space once.
+
+The deb of the installed version is taken, in order of preference, from
+an earlier backup, from APT's download cache, or else rebuilt with
+dpkg-repack; several packages are repacked at once."""
+
+import concurrent.futures
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import archives
+import perform
+import util
+
+backup_dir = os.path.join(util.init_dir, "backups")
+store_dir = os.path.join(backup_dir, "store")
+
+# Number of dated backups kept; older ones are deleted after a backup.
+KEEP = 5
+WORKERS = os.cpu_count() or 2
+
+
+def deb_filename(name, version, arch):
+    return "{}_{}_{}.deb".format(name, version.replace(":", "%3a"), arch)
+
+
+def dated_dirs():
+    """Return the dated backup directories, oldest first"""
+    if not os.path.exists(backup_dir):
+        return []
+    return sorted(entry.path for entry in os.scandir(backup_dir)
+                  if entry.is_dir() and entry.name != "store")
+
+
+def backed_up():
+    """Return a dict of deb file name to a path holding it in a backup"""
+    debs = dict()
+    for directory in dated_dirs():
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".deb"):
+                debs[entry.name] = entry.path
+    return debs
+
+
+def link(source, target):
+    """Hard link SOURCE to TARGET, copying (reflinked if possible) when
+    the two are on different filesystems or linking is not allowed"""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        subprocess.call(["cp", "--reflink=auto", source, target])
+
+
+def store(source, target):
+    """Save SOURCE in the content-addressed store and link it to TARGET"""
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+    stored = os.path.join(store_dir, digest.hexdigest() + ".deb")
+    if not os.path.exists(stored):
+        link(source, stored)
+    link(stored, target)
+
+
+def repack(package, target):
+    """Rebuild the deb of an installed package with dpkg-repack"""
+    workdir = tempfile.mkdtemp(prefix="repack.")
+    try:
+        command = "cd {} && fakeroot -u dpkg-repack {} >/dev/null"
+        perform.execute(command.format(workdir, package))
+        for filename in os.listdir(workdir):
+            if filename.endswith(".deb"):
+                store(os.path.join(workdir, filename), target)
+                return True
+        return False
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def prune(keep=KEEP):
+    """Delete all but the KEEP latest dated backups, then any stored deb
+    no dated backup links to any more"""
+    dirs = dated_dirs()
+    for directory in dirs[:max(len(dirs) - keep, 0)]:
+        shutil.rmtree(directory)
+    for entry in os.scandir(store_dir):
+        if entry.stat().st_nlink == 1:
+            os.remove(entry.path)
+
+
+def backup_before_upgrade(packages, keep=KEEP):
+    """Backup packages before a (dist)upgrade.
+
+     This optional functionality helps recovery in case of trouble caused
+     by the newly-installed packages. The packages are by default stored
+     in a directory named like  ~/.wajig/hostname/backups/2010-09-21_09h21."""
+
+    date = time.strftime("%Y-%m-%d_%Hh%M", time.localtime())
+    target = os.path.join(backup_dir, date)
+    for directory in (target, store_dir):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+    print("The packages will saved in", target)
+
+    installed = util.installed_packages()
+    existing = backed_up()
+    reused = cached = 0
+    missing = list()
+    for package in packages:
+        entry = installed.get(package)
+        if entry is None:
+            continue
+        name, version = entry["Package"], entry["Version"]
+        arch = entry["Architecture"]
+        filename = deb_filename(name, version, arch)
+        destination = os.path.join(target, filename)
+        if filename in existing:
+            link(existing[filename], destination)
+            reused += 1
+            continue
+        deb = archives.find(name, version, arch)
+        if deb is not None:
+            store(deb.path, destination)
+            cached += 1
+        else:
+            missing.append((package, destination))
+
+    repacked = 0
+    if missing:
+        util.requires_package("dpkg-repack")
+        util.requires_package("fakeroot")
+        with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+            futures = [pool.submit(repack, package, destination)
+                       for package, destination in missing]
+            repacked = sum(future.result() for future in futures)
+
+    message = "{} reused from earlier backups, {} from the download cache, " \
+              "{} repacked"
+    print(message.format(reused, cached, repacked))
+    if repacked < len(missing):
+        print("Could not repack {} packages.".format(len(missing) - repacked))
+    prune(keep)
@@ -0,0 +1,167 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Run a script of wajig commands within a single process.
+
+Each line is parsed by the very parser used for the command line, so a
+script reads like a series of wajig invocations without the leading
+'wajig'. Running them in one process means the APT cache, the parsed
+dpkg status and the root helper are set up once rather than per line."""
+
+import collections
+import shlex
+import sys
+import time
+
+import commands
+import perform
+import util
+import wajig
+
+# Commands whose consecutive lines may be joined into one apt transaction.
+MERGEABLE = (commands.install, commands.remove, commands.purge)
+
+
+def read_script(path):
+    """Yield the line number and text of each command in the script"""
+    f = sys.stdin if path == "-" else open(path)
+    with f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield number, line
+
+
+def report(first, last, status, elapsed, text):
+    lines = str(first) if first == last else "{}-{}".format(first, last)
+    message = "batch: line {}: exit {} ({:.2f}s) {}"
+    print(message.format(lines, status, elapsed, text), file=sys.stderr)
+    sys.stderr.flush()
+
+
+def parse(parser, line):
+    """Parse one script line, returning None if it is not a valid command"""
+    try:
+        args = parser.parse_args(shlex.split(line))
+    except (SystemExit, ValueError):
+        return None
+    if not hasattr(args, "func") or args.func is commands.batch:
+        return None
+    # Options only ever switch these on, so start each line afresh.
+    perform.SIMULATE = False
+    perform.TEACH = False
+    return wajig.set_options(args)
+
+
+def execute(args):
+    """Run a command, turning its outcome into an exit status"""
+    try:
+        status = args.func(args)
+    except SystemExit as error:
+        status = error.code
+    except Exception as error:
+        # One failing line must not abandon the rest of the script.
+        print("batch: {}".format(error), file=sys.stderr)
+        status = 1
+    if status is None:
+        return 0
+    return status if isinstance(status, int) else 1
+
+
+def mergeable(args):
+    if args.func not in MERGEABLE:
+        return False
+    packages = util.consolidate_package_names(args)
+    return not any(package.endswith(".deb") or "://" in package
+                   for package in packages)
+
+
+def merge_key(args):
+    return (args.yes, args.noauth, getattr(args, "recommends", ""),
+            getattr(args, "dist", ""), args.simulate, args.teach)
+
+
+def compatible(group, args):
+    """Check whether a line can join the pending group of lines"""
+    if merge_key(group[0][2]) != merge_key(args):
+        return False
+    # apt-get purges either all or none of the removals of a transaction.
+    functions = {entry[2].func for entry in group} | {args.func}
+    return not {commands.remove, commands.purge} <= functions
+
+
+def execute_merged(group):
+    """Perform a group of install/remove/purge lines as one transaction"""
+    first = group[0][2]
+    actions = collections.OrderedDict()
+    for number, line, args in group:
+        suffix = "" if args.func is commands.install else "-"
+        for package in sorted(util.consolidate_package_names(args)):
+            # A later line overrides what an earlier one asked for.
+            actions.pop(package, None)
+            actions[package] = suffix
+    purge = any(args.func is commands.purge for number, line, args in group)
+    dist = getattr(first, "dist", "")
+    if dist:
+        dist = "--target-release " + dist
+    command = "/usr/bin/apt {} {} {} {} --auto-remove {} install {}".format(
+        first.yes, first.noauth, getattr(first, "recommends", ""), dist,
+        "--purge" if purge else "",
+        " ".join(package + suffix for package, suffix in actions.items())
+    )
+    perform.SIMULATE = first.simulate
+    perform.TEACH = first.teach
+    return perform.execute(command, root=True, log=True) or 0
+
+
+def flush(group):
+    """Run the pending group of mergeable lines, returning failed lines"""
+    if not group:
+        return 0
+    start = time.monotonic()
+    if len(group) == 1:
+        status = execute(group[0][2])
+    else:
+        status = execute_merged(group)
+    text = " + ".join(line for number, line, args in group)
+    report(group[0][0], group[-1][0], status, time.monotonic() - start, text)
+    failed = len(group) if status else 0
+    del group[:]
+    return failed
+
+
+def run(path, merge=False):
+    """Run every command of the script, returning the number that failed"""
+    parser = wajig.build_parser()
+    failed = 0
+    total = 0
+    group = list()
+    for number, line in read_script(path):
+        total += 1
+        args = parse(parser, line)
+        if args is not None and (args.root or args.roots):
+            # Switching roots would carry over to the lines that follow.
+            print("batch: line {}: --root and --roots are not supported "
+                  "in a script".format(number), file=sys.stderr)
+            failed += flush(group) + 1
+            report(number, number, 2, 0, line)
+            continue
+        if args is not None and merge and mergeable(args):
+            if group and not compatible(group, args):
+                failed += flush(group)
+            group.append((number, line, args))
+            continue
+        failed += flush(group)
+        start = time.monotonic()
+        if args is None:
+            print("batch: line {}: not a wajig command".format(number),
+                  file=sys.stderr)
+            status = 2
+        else:
+            status = execute(args)
+        report(number, number, status, time.monotonic() - start, line)
+        if status:
+            failed += 1
+    failed += flush(group)
+    message = "batch: {} of {} commands failed"
+    print(message.format(failed, total), file=sys.stderr)
+    return failed
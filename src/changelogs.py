@@ -0,0 +1,239 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Fetch the changelogs of pending upgrades.
+
+The changelogs of all upgradable packages are downloaded concurrently
+from the URLs APT itself would use (see 'apt-get changelog'), once per
+source package, and kept in ~/.wajig/<hostname>/changelogs named after
+the source package and version, so reviewing the same upgrades again
+needs no network at all. Only the entries newer than the installed
+version are shown.
+
+When the new version is already in APT's download cache, as after
+AUTODOWNLOAD, its changelog and NEWS are instead read from the .deb
+itself, so pending upgrades can be reviewed without any network."""
+
+import concurrent.futures
+import gzip
+import io
+import os
+import re
+import shlex
+import subprocess
+import tempfile
+import urllib.error
+import urllib.request
+
+import apt_pkg
+
+import archives
+import debreader
+import util
+
+cache_dir = os.path.join(util.init_dir, "changelogs")
+
+WORKERS = 8
+TIMEOUT = 30
+
+# The first line of each entry: package (version) distributions; urgency
+HEADER = re.compile(r"^(\S+) \(([^() \t]+)\)")
+
+
+def cache_path(source, version):
+    version = version.replace(":", "%3a")
+    return os.path.join(cache_dir, "{}_{}".format(source, version))
+
+
+def newer_entries(lines, since=None):
+    """Yield the lines of the changelog entries newer than version SINCE,
+    or only those of the first entry when SINCE is None"""
+    entries = 0
+    for line in lines:
+        match = HEADER.match(line)
+        if match:
+            entries += 1
+            if since is None:
+                if entries > 1:
+                    return
+            elif apt_pkg.version_compare(match.group(2), since) <= 0:
+                return
+        yield line
+
+
+def read_entries(member, since):
+    """Return the newer entries of a gzipped changelog tar MEMBER; the
+    rest of it is never decompressed"""
+    with gzip.GzipFile(fileobj=member, mode="rb") as f:
+        text = io.TextIOWrapper(f, encoding="utf-8", errors="replace")
+        lines = (line.rstrip("\n") for line in text)
+        return list(newer_entries(lines, since))
+
+
+def from_deb(path, package, since=None):
+    """Read what is new since version SINCE from the changelog and NEWS
+    of a .deb, returning (changelog lines, NEWS lines), or None when the
+    package ships no changelog of its own"""
+    docs = "usr/share/doc/{}/".format(package)
+    news = list()
+    with debreader.open_tar(path, "data.tar") as tar:
+        for member in tar:
+            name = debreader.member_path(member)
+            if not name.startswith(docs) or not member.isfile():
+                continue
+            name = name[len(docs):]
+            if name == "NEWS.Debian.gz":
+                news = read_entries(tar.extractfile(member), since)
+            elif name in ("changelog.Debian.gz", "changelog.gz"):
+                # dpkg-deb sorts members by name, so NEWS came earlier.
+                return read_entries(tar.extractfile(member), since), news
+    return None
+
+
+def deb_changes(name, version, arch, since):
+    """Return (changelog lines, NEWS lines) newer than version SINCE from
+    the .deb of a package version in the download cache, or None"""
+    deb = archives.find(name, version, arch)
+    if deb is None:
+        return None
+    try:
+        return from_deb(deb.path, name, since)
+    except debreader.READ_ERRORS:
+        return None
+
+
+def cached_changes(package):
+    """Return what is new in the candidate of an apt package, when its
+    .deb is in the download cache, or else None"""
+    candidate = package.candidate
+    if candidate is None or candidate == package.installed:
+        return None
+    since = package.installed.version if package.installed else None
+    return deb_changes(package.shortname, candidate.version,
+                       candidate.architecture, since)
+
+
+def print_uris(packages):
+    """Yield the (URL, file name) pairs apt-get prints for the changelogs
+    of the candidates of PACKAGES"""
+    command = "apt-get {} changelog --print-uris {}".format(
+        util.apt_options, " ".join(packages))
+    try:
+        output = subprocess.check_output(command, shell=True,
+                                         stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as error:
+        output = error.output
+    for line in output.decode().splitlines():
+        fields = shlex.split(line)
+        if len(fields) >= 2:
+            yield fields[0], fields[1]
+
+
+def changelog_uris(packages):
+    """Return the URL of the candidate's changelog for each package
+
+    apt-get names the file of each URL package.changelog, which maps the
+    URLs back to the packages; any package no line can be matched to is
+    asked about on its own."""
+    uris = dict()
+    for uri, filename in print_uris(packages):
+        name = filename.rpartition(".changelog")[0].partition(":")[0]
+        uris.setdefault(name, uri)
+    for package in packages:
+        if package not in uris:
+            for uri, filename in print_uris([package]):
+                uris[package] = uri
+    return {package: uris[package] for package in packages
+            if package in uris}
+
+
+def fetch(source, version, uri):
+    """Return the changelog text of a source version, fetching it once"""
+    path = cache_path(source, version)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return f.read()
+    if not uri:
+        raise urllib.error.URLError("no changelog location is known")
+    with urllib.request.urlopen(uri, timeout=TIMEOUT) as response:
+        text = response.read().decode("utf-8", errors="replace")
+    temporary_file = tempfile.mkstemp(dir=cache_dir)[1]
+    with open(temporary_file, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temporary_file, path)
+    return text
+
+
+def pending():
+    """Return (source, installed, candidate, binaries) for each source
+    package having upgradable binaries, sorted by source name; BINARIES
+    holds the name, candidate version and architecture of each"""
+    sources = dict()
+    for package in util.upgradable(get_names_only=False):
+        candidate = package.candidate
+        if candidate is None:
+            continue
+        key = (candidate.source_name, candidate.source_version)
+        if key not in sources:
+            installed = package.installed
+            since = installed.source_version if installed else None
+            sources[key] = [since, []]
+        sources[key][1].append((package.shortname, candidate.version,
+                                candidate.architecture))
+    return sorted((source, since, version, sorted(binaries))
+                  for (source, version), (since, binaries)
+                  in sources.items())
+
+
+def review(source, since, version, binaries, uri):
+    """Return (changelog lines, NEWS lines) newer than version SINCE for
+    an upgrade, preferring the downloaded .debs to the network"""
+    for name, binary_version, arch in binaries:
+        changes = deb_changes(name, binary_version, arch, since)
+        if changes is not None:
+            return changes
+    text = fetch(source, version, uri)
+    return list(newer_entries(text.splitlines(), since)), []
+
+
+def upgradable_changes():
+    """Yield (source, installed, candidate, binaries, changes or error)
+    for every pending upgrade, looking them up in parallel"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    upgrades = pending()
+    wanted = [binaries[0][0] for source, since, version, binaries in upgrades
+              if not os.path.exists(cache_path(source, version)) and
+              not any(archives.find(name, binary_version, arch)
+                      for name, binary_version, arch in binaries)]
+    uris = changelog_uris(wanted) if wanted else dict()
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+        futures = [pool.submit(review, source, since, version, binaries,
+                               uris.get(binaries[0][0]))
+                   for source, since, version, binaries in upgrades]
+        for (source, since, version, binaries), future in zip(upgrades,
+                                                               futures):
+            try:
+                changes = future.result()
+            except (urllib.error.URLError, OSError) as error:
+                yield source, since, version, binaries, error
+            else:
+                yield source, since, version, binaries, changes
+
+
+def show_upgradable():
+    """Print what is new in each pending upgrade"""
+    count = 0
+    for source, since, version, binaries, changes in upgradable_changes():
+        count += 1
+        header = " {} {} -> {} ".format(source, since or "(new)", version)
+        print("{:=^79}".format(header))
+        print("Binary packages:", " ".join(name for name, v, a in binaries))
+        if isinstance(changes, Exception):
+            print("Failed to download the list of changes:", changes)
+            continue
+        lines, news = changes
+        if news:
+            print("\n".join(news))
+        print("\n".join(lines))
+    if not count:
+        print("No upgrades are pending.")
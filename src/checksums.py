@@ -0,0 +1,211 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Check installed files against the md5sums recorded by dpkg.
+
+The sums come from /var/lib/dpkg/info/<package>.md5sums and, for
+configuration files, from the Conffiles of the dpkg status. Files are
+hashed several at a time, large ones through mmap, and the digest of
+each file is remembered in ~/.wajig/<hostname>/Md5Cache under its
+device, inode, size, modification and change times, so a later check
+only reads the files changed since."""
+
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+
+import util
+
+WORKERS = min(32, (os.cpu_count() or 1) * 4)
+MMAP_SIZE = 1 << 20
+BATCH = 1024
+
+OK = "ok"
+CHANGED = "changed"
+MISSING = "missing"
+UNREADABLE = "unreadable"
+
+
+def info_file(entry, suffix):
+    """Return the dpkg info file of a package, named with the architecture
+    for Multi-Arch: same packages, or None"""
+    for name in (entry["Package"],
+                 "{}:{}".format(entry["Package"], entry["Architecture"])):
+        path = os.path.join(util.info_dir, name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def conffiles(entry):
+    """Yield (path, md5) for the current conffiles of a status entry"""
+    for line in entry.get("Conffiles", "").splitlines():
+        fields = line.split()
+        if len(fields) < 2 or "obsolete" in fields[2:]:
+            continue
+        # A conffile not yet configured has 'newconffile' as its sum.
+        if len(fields[1]) == 32:
+            yield fields[0], fields[1]
+
+
+def md5sums(entry):
+    """Yield (path, md5) for the files listed in a package's md5sums"""
+    path = info_file(entry, ".md5sums")
+    if path is None:
+        return
+    with open(path, "rb") as f:
+        for line in f:
+            digest, sep, name = line.rstrip(b"\n").partition(b"  ")
+            if sep:
+                yield "/" + name.decode(errors="surrogateescape"), \
+                    digest.decode()
+
+
+def diversions():
+    """Return a dict of diverted path to (new path, diverting package)"""
+    diverted = dict()
+    path = os.path.join(os.path.dirname(util.info_dir), "diversions")
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return diverted
+    for start in range(0, len(lines) - 2, 3):
+        source, target, package = lines[start:start + 3]
+        diverted[source] = (target, package)
+    return diverted
+
+
+def expected(packages=None, include_conffiles=True, only_conffiles=False):
+    """Return (package, path on disk, md5, is conffile) for each file of
+    the installed PACKAGES, by default all of them"""
+    installed = util.installed_packages()
+    if packages is None:
+        packages = sorted(installed)
+    diverted = diversions()
+    files = list()
+    for package in packages:
+        entry = installed.get(package)
+        if entry is None:
+            continue
+        sums = list()
+        if not only_conffiles:
+            sums.extend((path, md5, False) for path, md5 in md5sums(entry))
+        if include_conffiles or only_conffiles:
+            listed = set(path for path, md5, conffile in sums)
+            sums.extend((path, md5, True) for path, md5 in conffiles(entry)
+                        if path not in listed)
+        for path, md5, conffile in sums:
+            # A file diverted by another package now lives elsewhere.
+            target, by = diverted.get(path, (None, None))
+            if target is not None and by != entry["Package"]:
+                path = target
+            local = os.path.join(util.root_dir, path.lstrip("/"))
+            files.append((package, local, md5, conffile))
+    return files
+
+
+def file_key(info):
+    return (info.st_dev, info.st_ino, info.st_size, info.st_mtime_ns,
+            info.st_ctime_ns)
+
+
+def md5_file(path):
+    """Return the md5 of a file, mapping large files rather than reading"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.md5(mm).hexdigest()
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def load_cache():
+    try:
+        with open(util.md5_cache, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+
+
+def save_cache(cache):
+    directory = os.path.dirname(util.md5_cache)
+    temporary_file = tempfile.mkstemp(dir=directory)[1]
+    with open(temporary_file, "wb") as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file, util.md5_cache)
+
+
+def check(files, prune=False):
+    """Check (package, path, md5, is conffile) FILES, returning a list of
+    (status, package, path, is conffile) in the same order and the number
+    of files that had to be read
+
+    With PRUNE the cache keeps only the files of this check, as is right
+    when checking every package."""
+    cache = load_cache()
+    kept = dict()
+    results = [None] * len(files)
+    pending = list()
+    for number, (package, path, md5, conffile) in enumerate(files):
+        try:
+            key = file_key(os.stat(path))
+        except FileNotFoundError:
+            results[number] = (MISSING, package, path, conffile)
+            continue
+        except OSError:
+            results[number] = (UNREADABLE, package, path, conffile)
+            continue
+        digest = cache.get(key)
+        if digest is None:
+            pending.append((number, key))
+        else:
+            kept[key] = digest
+            status = OK if digest == md5 else CHANGED
+            results[number] = (status, package, path, conffile)
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+        # Submit in batches to bound the number of futures alive at once.
+        for start in range(0, len(pending), BATCH):
+            batch = pending[start:start + BATCH]
+            futures = [pool.submit(md5_file, files[number][1])
+                       for number, key in batch]
+            for (number, key), future in zip(batch, futures):
+                package, path, md5, conffile = files[number]
+                try:
+                    digest = future.result()
+                except FileNotFoundError:
+                    status = MISSING
+                except OSError:
+                    status = UNREADABLE
+                else:
+                    kept[key] = digest
+                    status = OK if digest == md5 else CHANGED
+                results[number] = (status, package, path, conffile)
+    if not prune:
+        cache.update(kept)
+        kept = cache
+    if pending or prune:
+        save_cache(kept)
+    return results, len(pending)
+
+
+def report(results, as_json=False):
+    """Print check results as a table, or as JSON"""
+    try:
+        if as_json:
+            print(json.dumps([dict(status=status, package=package, path=path,
+                                   conffile=conffile)
+                              for status, package, path, conffile in results],
+                             indent=2))
+            return
+        sys.stdout.flush()
+        for status, package, path, conffile in results:
+            line = "{:<10} {:<28} {}{}\n".format(
+                status, package, path, " (conffile)" if conffile else "")
+            # Paths that are not valid UTF-8 are written as their bytes.
+            sys.stdout.buffer.write(os.fsencode(line))
+    except BrokenPipeError:
+        util.stdout_closed()
@@ -5,19 +5,32 @@
 # Do not include any function in here that does not correspond to a COMMAND
 
 import os
+import re
+import sys
+import json
+import stat
 import inspect
 import tempfile
-import subprocess
 import urllib.request
 import webbrowser
-import shutil
-
-import apt
 
 # wajig modules
 import perform
 import util
+import archives
+import backup
+import changelogs
+import checksums
+import contentsindex
 import debfile
+import debreader
+import debscan
+import depgraph
+import downloads
+import fileindex
+import fleet
+import pristine
+import snapshots
 
 # before we do any other command make sure the right files exist
 util.ensure_initialised()
@@ -77,6 +90,25 @@ def autoremove(args):
     perform.execute("/usr/bin/apt autoremove", root=True, log=True)
 
 
+def batch(args):
+    """Run the wajig commands listed in a file ('-' for standard input)
+
+    Each line holds a command as it would be typed after 'wajig'; blank
+    lines and lines starting with '#' are ignored. All lines run in one
+    process, sharing the package cache and status, and the exit status
+    and time taken are reported for each line:
+
+    $ printf "hold 'linux-*'\ninstall -y vim\nstatus vim\n" | wajig batch -
+
+    With --merge, consecutive INSTALL, REMOVE and PURGE lines having the
+    same options are performed as a single apt transaction. Script lines
+    cannot use --root or --roots.
+    """
+    import batch
+    if batch.run(args.script, args.merge):
+        sys.exit(1)
+
+
 def build(args):
     """Get source packages, unpack them, and build binary packages from them.
 
@@ -109,13 +141,39 @@ def changelog(args):
          changelog - if there's newer entries, mention failure to retrieve
       -v changelog - if there's newer entries, mention failure to retrieve, and
                      proceed to display complete local changelog
+
+    When the new version has already been downloaded (see AUTODOWNLOAD),
+    its changes are read from the .deb in the download cache instead.
+
+    With --upgradable, show what is new in every pending upgrade instead.
+    The changelogs are fetched in parallel and kept, so that reviewing the
+    same upgrades again needs no network:
+
+    $ wajig changelog --upgradable | less
     """
 
-    package = util.package_exists(apt.Cache(), args.package)
+    if args.upgradable:
+        try:
+            changelogs.show_upgradable()
+        except BrokenPipeError:
+            util.stdout_closed()
+        return
+    if args.package is None:
+        print("Give a package name, or --upgradable for all pending upgrades.")
+        sys.exit(1)
+    package = util.package_exists(util.get_cache(), args.package)
     changelog = "{:=^79}\n".format(" {} ".format(args.package))  # header
 
     try:
-        changelog += package.get_changelog()
+        changes = changelogs.cached_changes(package)
+        if changes is None:
+            changelog += package.get_changelog()
+        else:
+            lines, news = changes
+            changelog += "\n".join(news + lines)
+            if args.verbose:
+                # The local changelog header follows on a line of its own.
+                changelog += "\n"
     except AttributeError:
         # This is caught so as to avoid an ugly python-apt trace; it's a bug
         # that surfaces when:
@@ -135,25 +193,16 @@ def changelog(args):
         changelog += ".\nYou are likely running the latest version.\n"
         if not args.verbose:
             changelog += help_message
-    if not args.verbose:
-        print(changelog)
-    else:
-        tmp = tempfile.mkstemp()[1]
-        with open(tmp, "w") as f:
-            if package.is_installed:
-                changelog += "{:=^79}\n".format(" local changelog ")
-            f.write(changelog)
-        if package.is_installed:
-            command = util.local_changelog(args.package, tmp)
-            if not command:
-                return
-            perform.execute(command)
-        with open(tmp) as f:
-            for line in f:
-                try:
-                    print(line, end="")
-                except BrokenPipeError:
-                    return
+    if package.is_installed and args.verbose:
+        changelog += "{:=^79}\n".format(" local changelog ")
+    try:
+        print(changelog, end="" if args.verbose else "\n")
+        if package.is_installed and args.verbose:
+            path = util.local_changelog(args.package)
+            if path:
+                util.stream_doc(path)
+    except BrokenPipeError:
+        util.stdout_closed()
 
 
 def clean(args):
@@ -161,9 +210,86 @@ def clean(args):
     perform.execute("/usr/bin/apt-get clean", root=True)
 
 
+def conffiles(args):
+    """Show the configuration files changed from their packaged version
+
+    The md5 of each conffile recorded by dpkg is checked, for all
+    installed packages or the given ones, and for every changed file a
+    unified diff against the packaged original is shown. The original is
+    read from the .deb of the installed version in the download cache
+    (see DOWNLOAD) or in the backups made by 'upgrade --backup':
+
+    $ wajig conffiles openssh-server
+    $ wajig conffiles --list
+    """
+    installed = util.installed_packages()
+    unknown = [package for package in args.packages
+               if package not in installed]
+    if unknown:
+        print("Not installed:", " ".join(unknown))
+        sys.exit(1)
+    files = checksums.expected(args.packages or None, only_conffiles=True)
+    results, read = checksums.check(files)
+    diverted = pristine.diverted_from()
+    changed = dict()
+    on_disk = dict()
+    for status, package, path, conffile in results:
+        if status == checksums.OK:
+            continue
+        if args.list or status != checksums.CHANGED:
+            print("{:<10} {:<28} {}".format(status, package, path))
+        if status == checksums.CHANGED:
+            path = os.path.relpath(path, util.root_dir)
+            # The .deb holds a diverted file under its packaged path.
+            packaged, by = diverted.get(path, (path, package))
+            if by != package:
+                on_disk[package, packaged] = path
+                path = packaged
+            changed.setdefault(package, []).append(path)
+    if args.list or not changed:
+        return
+    try:
+        for package, deb, originals in pristine.originals(changed):
+            version = installed[package]["Version"]
+            for path in changed[package]:
+                if path not in originals:
+                    print("{:<10} {:<28} /{}: no .deb of version {} found; "
+                          "'wajig download {}' may fetch it".format(
+                              "changed", package, path, version, package))
+                    continue
+                label = "/{} ({} {})".format(path, package, version)
+                for line in pristine.unified_diff(
+                        on_disk.get((package, path), path), originals[path],
+                        label):
+                    sys.stdout.write(line)
+                    if not line.endswith("\n"):
+                        sys.stdout.write("\n")
+    except BrokenPipeError:
+        util.stdout_closed()
+
+
 def contents(args):
-    """List the contents of a package file (.deb)"""
-    perform.execute("dpkg --contents " + args.debfile)
+    """List the contents of package files (.deb)
+
+    Directories and glob patterns stand for the .deb files they hold.
+    With several files each line starts with the file it lists; use
+    --json for one JSON object per file and line. What was read is
+    cached, so listing an unchanged file again is nearly free.
+    """
+    if args.json or debscan.bulk(args.debfiles):
+        if debscan.report(args.debfiles, debscan.CONTENTS, args.json):
+            sys.exit(1)
+        return
+    debfile = args.debfiles[0]
+    try:
+        with debreader.open_tar(debfile, "data.tar") as tar:
+            for member in tar:
+                print(debreader.listing(debreader.member_entry(member)))
+    except BrokenPipeError:
+        util.stdout_closed()
+    except debreader.READ_ERRORS as e:
+        print("{}: {}".format(debfile, e))
+        sys.exit(1)
 
 
 def dailyupgrade(args):
@@ -192,7 +318,7 @@ def dependents(args):
         "Enhances",
     ]
 
-    cache = apt.cache.Cache()
+    cache = util.get_cache()
     package = util.package_exists(cache, args.package)
     dependents = {name : [] for name in DEPENDENCY_TYPES}
 
@@ -211,7 +337,23 @@ def dependents(args):
 
 
 def describe(args):
-    """Display one-line descriptions for the given packages"""
+    """Display one-line descriptions for the given packages
+
+    Package files (.deb) can be given too, as well as directories and
+    glob patterns standing for the .deb files they hold; these are read
+    in parallel and shown as a table, or with --json as one JSON object
+    per line.
+    """
+    files = [package for package in args.packages
+             if debscan.is_file_argument(package)]
+    if files and (args.json or debscan.bulk(files)):
+        names = [package for package in args.packages if package not in files]
+        if names:
+            util.do_describe(names, args.verbose)
+        if debscan.report(files, debscan.DESCRIBE, args.json,
+                          verbose=args.verbose):
+            sys.exit(1)
+        return
     util.do_describe(args.packages, args.verbose)
 
 
@@ -236,9 +378,7 @@ def distupgrade(args):
         print('No upgrades. Did you run "wajig update" beforehand?')
         return
     if args.backup:
-        util.requires_package("dpkg-repack")
-        util.requires_package("fakeroot")
-        util.backup_before_upgrade(packages, distupgrade=True)
+        backup.backup_before_upgrade(packages, args.keep_backups)
     cmd = "/usr/bin/apt --show-upgraded {} {} {} ".format(
         args.local, args.yes, args.noauth
     )
@@ -248,6 +388,38 @@ def distupgrade(args):
     perform.execute(cmd, root=True, log=True)
 
 
+def docsearch(args):
+    """Find the installed packages whose README, NEWS or changelog mention
+    all the given words
+
+    The documents under /usr/share/doc are indexed on first use; later
+    searches only read the documents changed since. The best matching
+    documents come first, with the lines holding the words:
+
+    $ wajig docsearch systemd timer
+    """
+    import docindex
+    query = " ".join(args.words)
+    hits = docindex.search(query)
+    if not hits:
+        print("No documents mention all of:", query)
+        return
+    try:
+        for score, path in hits[:args.limit]:
+            package, filename = path.split(os.sep)[-2:]
+            print("{:<32} {:<24} {:.1f}".format(package, filename, score))
+            lines = list(docindex.matching_lines(path, query))
+            for number, line in lines[:args.lines]:
+                print("{:>8}: {}".format(number, line.strip()))
+            if len(lines) > args.lines:
+                print("{:>8}  ... {} more".format("", len(lines) - args.lines))
+        if len(hits) > args.limit:
+            print("{} more documents; use --limit to see them".format(
+                len(hits) - args.limit))
+    except BrokenPipeError:
+        util.stdout_closed()
+
+
 def download(args):
     """Download one or more packages without installing them"""
     print("Packages being downloaded to /var/cache/apt/archives/")
@@ -286,6 +458,21 @@ def fixmissing(args):
     perform.execute(command, root=True, log=True)
 
 
+def fleetdiff(args):
+    """Compare the package snapshots of hosts sharing this home directory
+
+    Every host running 'wajig snapshot' keeps its latest snapshot under
+    ~/.wajig/<hostname>. Packages missing from some hosts, found on only
+    a few, or at a version behind or ahead of most hosts are reported:
+
+    $ wajig fleetdiff
+    $ wajig fleetdiff web1 web2 web3
+    """
+    status = fleet.report(args.hosts)
+    if status:
+        sys.exit(status)
+
+
 def force(args):
     """Install packages and ignore file overwrites and depends
 
@@ -295,20 +482,20 @@ def force(args):
     """
 
     command = "/usr/bin/dpkg --install --force overwrite --force depends "
-    archives = "/var/cache/apt/archives/"
+    cache_dir = archives.archives_dir()
 
     # For a .deb file we simply force install it.
     if args.packages[0].endswith(".deb"):
         for package in args.packages:
             if os.path.exists(package):
                 command += "'" + package + "' "
-            elif os.path.exists(archives + package):
-                command += "'" + archives + package + "' "
+            elif os.path.exists(cache_dir + package):
+                command += "'" + cache_dir + package + "' "
             else:
                 message = ("File {} not found. "
                            "Searched current directory and {}."
                            "Please confirm the location and try again.")
-                print(message.format(package, archives))
+                print(message.format(package, cache_dir))
                 return()
     else:
         # Package names rather than a specific deb package archive
@@ -316,10 +503,7 @@ def force(args):
         for package in args.packages:
             # Identify the latest version of the package available in
             # the download archive, if there is any there.
-            lscmd = "ls {} | grep -E '^{}_' | sort -k 1b,1 | tail -n -1"
-            lscmd = lscmd.format(archives, package)
-            matches = perform.execute(lscmd, pipe=True)
-            debpkg = matches.readline().strip()
+            debpkg = archives.newest(package)
 
             if not debpkg:
                 dlcmd = (
@@ -327,29 +511,57 @@ def force(args):
                     "install '{}'"
                 ).format(package)
                 perform.execute(dlcmd, root=True)
-                matches = perform.execute(lscmd, pipe=True)
-                debpkg = matches.readline().strip()
+                debpkg = archives.newest(package)
+                if not debpkg:
+                    print("No .deb of '{}' could be found or downloaded."
+                          .format(package))
+                    return
 
             # Force install the package from the download archive.
-            command += "'" + archives + debpkg + "' "
+            command += "'" + debpkg.path + "' "
 
     perform.execute(command, root=True, log=True)
 
 
 def hold(args):
-    """Place packages on hold (so they will not be upgraded)"""
-    for package in args.packages:
-        # The dpkg needs sudo but not the echo.
-        # Do all of it as root then!
-        command = '/bin/echo "{} hold" | /usr/bin/dpkg --set-selections'
-        perform.execute(command.format(package), root=True)
+    """Place packages on hold (so they will not be upgraded)
+
+    Glob and regular expression patterns are matched against the
+    installed packages; all of them are held in one dpkg call:
+    $ wajig hold 'linux-*' 'libreoffice-(core|writer)'
+    """
+    packages = util.resolve_packages(args.packages,
+                                     util.installed_packages())
+    util.set_selections(packages, "hold")
     print("The following packages are on hold:")
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for package in util.held_packages():
+        print(package)
 
 
 def info(args):
-    """List the information contained in a package file"""
-    perform.execute("dpkg --info " + args.package)
+    """List the information contained in package files
+
+    Directories and glob patterns stand for the .deb files they hold.
+    Several files are shown as a table of one line each, or with --json
+    as one JSON object per line; --sha256 adds the checksum of each file.
+    What was read is cached, so inspecting a mostly unchanged set of
+    files again is nearly free:
+
+    $ wajig info --json /srv/incoming/ > incoming.ndjson
+    """
+    if args.json or args.sha256 or debscan.bulk(args.debfiles):
+        if debscan.report(args.debfiles, debscan.INFO, args.json,
+                          args.sha256):
+            sys.exit(1)
+        return
+    debfile = args.debfiles[0]
+    try:
+        control = debreader.read_control(debfile)
+    except debreader.READ_ERRORS as e:
+        print("{}: {}".format(debfile, e))
+        sys.exit(1)
+    for line in debreader.info_lines(control):
+        print(line)
 
 
 def init(args):
@@ -364,7 +576,9 @@ def install(args):
     * specifying a .deb file will also try to satisfy that deb's dependencies;
     * one can specify multiple files with --fileinput option
     * specifying a url will try fetch the file from the internet, and keep it
-      in "~/.wajig/$HOSTNAME"
+      in "~/.wajig/$HOSTNAME/debs"; several urls are fetched at once, an
+      interrupted download resumes, and a url fetched before is not fetched
+      again; a "#sha256=...&size=..." suffix has the file verified
 
     example:
     $ wajig install a b_1.0_all.deb http://example.com/c_1.0_all.deb
@@ -377,22 +591,15 @@ def install(args):
 
     online_files = [
         package for package in packages if
-        package.startswith(("http://", "ftp://"))
+        package.startswith(("http://", "https://", "ftp://"))
     ]
-    deb_files = list()
+    urls = list()
     for package in online_files:
-        if not package.endswith(".deb"):
+        if not downloads.filename(package).endswith(".deb"):
             print("A valid .deb file should have a '.deb' extension")
             continue
-        filename = os.path.join(util.init_dir, package.split("/")[-1])
-        try:
-            response = urllib.request.urlopen(package)
-        except urllib.error.HTTPError as error:
-            print("{}; is '{}' the correct url?".format(error.reason, package))
-        else:
-            with open(filename, "wb") as f:
-                f.write(response.read())
-            deb_files.append(filename)
+        urls.append(package)
+    deb_files = downloads.fetch_all(urls)
 
     deb_files.extend([
         package for package in packages if package.endswith(".deb")
@@ -414,7 +621,7 @@ def install(args):
 
 def installsuggested(args):
     """Install a package and its Suggests dependencies"""
-    cache = apt.cache.Cache()
+    cache = util.get_cache()
     package = util.package_exists(cache, args.package,
                                   ignore_virtual_packages=True)
     dependencies = list(util.extract_dependencies(package, "Suggests"))
@@ -428,14 +635,33 @@ def installsuggested(args):
 
 
 def integrity(args):
-    """Check the integrity of installed packages (through checksums)"""
-    util.requires_package("debsums")
-    perform.execute("debsums --all --silent")
+    """Check the integrity of installed packages (through checksums)
+
+    Every file in the md5sums of the installed packages, and every
+    conffile, is checked against its recorded md5 and those changed,
+    missing or unreadable are reported. Files unchanged since an earlier
+    check are not read again. Use --json for a machine readable report.
+    """
+    results, read = checksums.check(checksums.expected(), prune=True)
+    problems = [result for result in results if result[0] != checksums.OK]
+    checksums.report(problems, args.json)
+    if not args.json:
+        print("{} files checked ({} read), {} problems".format(
+            len(results), read, len(problems)), file=sys.stderr)
+    if problems:
+        sys.exit(1)
 
 
 def large(args):
-    """List size of all large (>10MB) installed packages"""
-    util.sizes(size=10000)
+    """List size of all large (>10MB) installed packages
+
+    With --closure, list the manually installed packages whose removal,
+    along with all that only they keep installed, frees more than 10MB.
+    """
+    if args.closure:
+        depgraph.report_sizes(size=10000)
+    else:
+        util.sizes(size=10000)
 
 
 def lastupdate(args):
@@ -460,15 +686,47 @@ def listall(args):
 
 
 def listcache(args):
-    """List the contents of the download cache"""
-    command = "printf 'Found %d files %s in the cache.\n\n'\
-           $(ls /var/cache/apt/archives/ | wc -l) \
-           $(ls -sh /var/cache/apt/archives/ | head -1 | awk '{print $2}')"
-    perform.execute(command)
-    command = "ls /var/cache/apt/archives/"
-    if args.pattern:
-        command = "{} | grep -E '{}'".format(command, args.pattern)
-    perform.execute(command)
+    """List the contents of the download cache
+
+    For each package the number and size of its cached files are shown,
+    along with the bytes taken by stale versions (older than both the
+    installed and the candidate version) and by versions AUTOCLEAN
+    would delete since they can no longer be downloaded.
+
+    With --json, one JSON object is written per package as it is
+    processed, followed by one holding the totals.
+    """
+    totals = dict(files=0, bytes=0, stale_files=0, stale_bytes=0,
+                  autoclean_files=0, autoclean_bytes=0)
+    if not args.json:
+        print("{:<32} {:>6} {:>9} {:>9} {:>9}".format(
+            "Package", "Files", "Size", "Stale", "Autoclean"))
+        print("{}-{}-{}-{}-{}".format("="*32, "="*6, "="*9, "="*9, "="*9))
+    try:
+        for summary in archives.usage(args.pattern):
+            for key in totals:
+                totals[key] += summary[key]
+            if args.json:
+                print(json.dumps(summary), flush=True)
+            else:
+                print("{:<32} {:>6} {:>9} {:>9} {:>9}".format(
+                    summary["package"], summary["files"],
+                    util.human_size(summary["bytes"]),
+                    util.human_size(summary["stale_bytes"]),
+                    util.human_size(summary["autoclean_bytes"]),
+                ))
+        if args.json:
+            print(json.dumps(dict(totals, total=True)))
+        else:
+            message = ("\nFound {} files {} in the cache; {} in stale "
+                       "versions, {} would be freed by autoclean.")
+            print(message.format(
+                totals["files"], util.human_size(totals["bytes"]),
+                util.human_size(totals["stale_bytes"]),
+                util.human_size(totals["autoclean_bytes"]),
+            ))
+    except BrokenPipeError:
+        pass
 
 
 def listalternatives(args):
@@ -503,30 +761,82 @@ def listdaemons(args):
 
 
 def listfiles(args):
-    """List the files that are supplied by the named package"""
-    if args.package.endswith(".deb"):
-        perform.execute("dpkg --contents " + args.package)
-        return
+    """List the files that are supplied by the named packages
+
+    The file lists of installed packages are read directly from dpkg's
+    database. Use --files-only to leave out directories, --size for the
+    number and total size of the files, and --pattern to show only the
+    paths matching a regular expression:
+
+    $ wajig listfiles --files-only --size --pattern 'bin/' coreutils bash
+    """
+    pattern = re.compile(args.pattern.encode()) if args.pattern else None
+    out = sys.stdout.buffer
+    total_files = total_size = 0
     try:
-        output = perform.execute(
-            "dpkg --listfiles " + args.package, getoutput=True
-        )
-    except subprocess.CalledProcessError:
-        if shutil.which("apt-file"):
-            perform.execute("apt-file list --regexp ^{}$".format(args.package))
-    else:
-        for line in output.decode().strip().split('\n'):
-            print(line)
+        for package in args.packages:
+            if package.endswith(".deb"):
+                sys.stdout.flush()
+                perform.execute("dpkg --contents " + package)
+                continue
+            lists = fileindex.package_lists(package)
+            if lists:
+                paths = (path for name in lists
+                         for path in fileindex.read_list(name))
+            else:
+                try:
+                    files = contentsindex.package_files(package)
+                except OSError as error:
+                    print("Failed to read the Contents files:", error)
+                    sys.exit(1)
+                if files is None:
+                    print("Package '{}' is not installed. Install apt-file "
+                          "and run 'wajig update' to list the files of "
+                          "uninstalled packages.".format(package))
+                    continue
+                paths = (path.encode() for path in files)
+            count = size = 0
+            for path in paths:
+                if pattern and not pattern.search(path):
+                    continue
+                if args.files_only or args.size:
+                    try:
+                        info = os.lstat(os.path.join(util.root_dir.encode(),
+                                                     path.lstrip(b"/")))
+                    except OSError:
+                        info = None
+                    if info is not None and stat.S_ISDIR(info.st_mode):
+                        if args.files_only:
+                            continue
+                    else:
+                        count += 1
+                        if info is not None and stat.S_ISREG(info.st_mode):
+                            size += info.st_size
+                out.write(path + b"\n")
+            if args.size:
+                out.flush()
+                print("{}: {} files, {}".format(package, count,
+                                                util.human_size(size)))
+            total_files += count
+            total_size += size
+        if args.size and len(args.packages) > 1:
+            out.flush()
+            print("Total: {} files, {}".format(total_files,
+                                               util.human_size(total_size)))
+        out.flush()
+    except BrokenPipeError:
+        util.stdout_closed()
 
 
 def listhold(args):
     """List packages that are on hold (i.e. those that won't be upgraded)"""
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for package in util.held_packages():
+        print(package)
 
 
 def listinstalled(args):
     """List installed packages"""
-    command = "dpkg --get-selections | cut -f1"
+    command = "dpkg {} --get-selections | cut -f1".format(util.dpkg_options)
     if args.pattern:
         command += " | grep -E '{}' | sort -k 1b,1".format(args.pattern)
     perform.execute(command)
@@ -559,18 +869,19 @@ def listpackages(args):
 def listscripts(args):
     """List the control scripts of the package of deb file"""
     package = args.debfile
-    scripts = ["preinst", "postinst", "prerm", "postrm"]
+    scripts = debreader.SCRIPTS
     if package.endswith(".deb"):
-        command = "ar p " + package + " control.tar.gz | tar ztvf -"
-        pkgScripts = perform.execute(command, pipe=True).readlines()
+        try:
+            control = debreader.read_control(package)
+        except debreader.READ_ERRORS as e:
+            print("{}: {}".format(package, e))
+            sys.exit(1)
         for script in scripts:
-            if "./" + script in "".join(pkgScripts):
+            if script in control.files:
                 nlen = int((72 - len(script)) / 2)
                 print(">"*nlen, script, "<"*nlen)
-                command = "ar p " + package + " control.tar.gz |" +\
-                          "tar zxvf - -O ./" + script +\
-                          " 2>/dev/null"
-                perform.execute(command)
+                text = control.files[script][1]
+                print(text.decode(errors="replace"), end="")
     else:
         root = "/var/lib/dpkg/info/"
         for script in scripts:
@@ -586,7 +897,7 @@ def listsection(args):
 
     Note: Use the LISTSECTIONS command for a list of Debian Sections
     """
-    cache = apt.cache.Cache()
+    cache = util.get_cache()
     for package in cache.keys():
         package = cache[package]
         if package.section == args.section:
@@ -595,7 +906,7 @@ def listsection(args):
 
 def listsections(args):
     """List all available sections"""
-    cache = apt.cache.Cache()
+    cache = util.get_cache()
     sections = list()
     for package in cache.keys():
         package = cache[package]
@@ -617,11 +928,19 @@ def liststatus(args):
 
 def localupgrade(args):
     """Upgrade using only packages that are already downloaded"""
+    packages = [
+        package.name for package in util.upgradable(get_names_only=False)
+        if archives.find(package.shortname, package.candidate.version,
+                         package.candidate.architecture)
+    ]
+    if not packages:
+        print("No upgrades are waiting in the download cache.")
+        return
     command = (
         "/usr/bin/apt-get --no-download --ignore-missing "
-        "--show-upgraded upgrade"
+        "--show-upgraded --only-upgrade install " + " ".join(packages)
     )
-    perform.execute(command, root=True, log=True)
+    return perform.execute(command, root=True, log=True)
 
 
 def madison(args):
@@ -650,8 +969,8 @@ def newdetail(args):
 
 
 def news(args):
-    """Display the NEWS file of a given package"""
-    util.display_sys_docs(args.package, "NEWS.Debian NEWS".split())
+    """Display the NEWS file of the given packages"""
+    util.display_sys_docs(args.packages, "NEWS.Debian NEWS".split())
 
 
 def nonfree(args):
@@ -661,9 +980,19 @@ def nonfree(args):
 
 
 def orphans(args):
-    """List libraries not required by any installed package """
-    util.requires_package("deborphan")
-    perform.execute("deborphan")
+    """List libraries not required by any installed package
+
+    A library is taken as required when an installed package depends on,
+    recommends or suggests it, directly or through a virtual package.
+    Libraries required only by orphans are orphans too. Use --all to look
+    at packages of every section, and --auto to leave out packages that
+    were installed explicitly rather than as dependencies.
+    """
+    try:
+        for package in depgraph.find_orphans(args.all, args.auto):
+            print(package)
+    except BrokenPipeError:
+        util.stdout_closed()
 
 
 def policy(args):
@@ -671,6 +1000,37 @@ def policy(args):
     perform.execute("apt-cache policy " + " ".join(args.packages))
 
 
+def prunecache(args):
+    """Trim the download cache according to a retention policy
+
+    Of each package only the --keep newest versions are kept, as well as
+    the installed and candidate versions. With --max-size, the least
+    recently used of the remaining debs are also deleted until the cache
+    fits the budget. Use --dry-run to see what would go:
+
+    $ wajig prunecache --keep 1 --max-size 2G --dry-run
+    """
+    try:
+        budget = util.parse_size(args.max_size) if args.max_size else None
+    except ValueError as error:
+        print(error)
+        return 1
+    doomed, remaining = archives.prune_plan(args.keep, budget)
+    freed = 0
+    for deb, reason in sorted(doomed, key=lambda entry: entry[0].path):
+        freed += deb.size
+        print("{:<60} {:>9}  {}".format(
+            os.path.basename(deb.path), util.human_size(deb.size), reason))
+    verb = "would free" if args.dry_run else "frees"
+    print("Deleting {} files {} {}, leaving {} in the cache.".format(
+        len(doomed), verb, util.human_size(freed),
+        util.human_size(remaining)))
+    if doomed and not args.dry_run:
+        paths = "\0".join(deb.path for deb, reason in doomed)
+        return perform.execute("/usr/bin/xargs -0 /bin/rm -f", root=True,
+                               input=paths)
+
+
 def purge(args):
     """Remove one or more packages and their configuration files"""
     packages = util.consolidate_package_names(args)
@@ -681,16 +1041,15 @@ def purge(args):
 
 
 def purgeorphans(args):
-    """Purge orphaned libraries (not required by installed packages)"""
-    # Deborphans does not require root, but dpkg does,
-    # so build up the orphans list first, then pass that to dpkg.
-    util.requires_package("deborphan")
-    packages = ""
-    for package in perform.execute("deborphan", pipe=True):
-        packages += " " + package.strip()
+    """Purge orphaned libraries (not required by installed packages)
+
+    The orphans are those ORPHANS lists, given the same options, and are
+    purged in a single transaction.
+    """
+    packages = depgraph.find_orphans(args.all, args.auto)
     if packages:
         command = "/usr/bin/apt-get --auto-remove purge {} {}"
-        command = command.format(args.yes, packages)
+        command = command.format(args.yes, " ".join(packages))
         perform.execute(command, root=True, log=True)
 
 
@@ -719,14 +1078,14 @@ def rbuilddeps(args):
 
 
 def readme(args):
-    """Display the README file(s) of a given package
+    """Display the README file(s) of the given packages
 
     This will display README, README.Debian, README.rst, and USAGE
-    files of a package. It will also decompress them if they are
+    files of each package. It will also decompress them if they are
     postfixed with .gz.
     """
     matches = 'README README.Debian README.rst USAGE'
-    util.display_sys_docs(args.package, matches.split())
+    util.display_sys_docs(args.packages, matches.split())
 
 
 def recdownload(args):
@@ -734,7 +1093,7 @@ def recdownload(args):
 
     package_names = list()
 
-    cache = apt.cache.Cache()
+    cache = util.get_cache()
     for package in args.packages:
         util.package_exists(cache, package)
 
@@ -760,12 +1119,16 @@ def reconfigure(args):
 
 
 def recommended(args):
-    """Display packages installed as Recommends and have no dependents"""
-    perform.execute(
-        "aptitude search "
-        "'?and( ?automatic(?reverse-recommends(?installed)), "
-        "?not(?automatic(?reverse-depends(?installed))) )'"
-    )
+    """Display packages installed as Recommends and have no dependents
+
+    These are the automatically installed packages that some installed
+    package recommends but none depends on.
+    """
+    try:
+        for package in depgraph.load().recommended():
+            print(package)
+    except BrokenPipeError:
+        util.stdout_closed()
 
 
 def reinstall(args):
@@ -793,14 +1156,15 @@ def remove(args):
 
 
 def removeorphans(args):
-    """Remove orphaned libraries"""
-    util.requires_package("deborphan")
-    packages = ""
-    for package in perform.execute("deborphan", pipe=True):
-        packages += " " + package.strip()
+    """Remove orphaned libraries
+
+    The orphans are those ORPHANS lists, given the same options, and are
+    removed in a single transaction.
+    """
+    packages = depgraph.find_orphans(args.all, args.auto)
     if packages:
         command = "/usr/bin/apt-get --auto-remove remove {} {}"
-        command = command.format(args.yes, packages)
+        command = command.format(args.yes, " ".join(packages))
         perform.execute(command, root=True, log=True)
 
 
@@ -818,12 +1182,74 @@ def reportbug(args):
     perform.execute("reportbug " + args.package)
 
 
+def restore(args):
+    """Bring the installed packages back to those of a SNAPSHOT
+
+    Only what differs is changed: packages missing from the system are
+    installed, those at another version are upgraded or downgraded to
+    the snapshot version, and those not in the snapshot are removed,
+    all within one apt transaction:
+
+    $ wajig snapshot > before-upgrade
+    $ wajig restore before-upgrade
+    """
+    plan, unavailable = snapshots.plan_restore(args.snapshot)
+    for entry in unavailable:
+        print("Not available from any source, left as is:", entry)
+    if not any(plan.values()):
+        print("The installed packages already match the snapshot.")
+        return
+    print("{:<10} {:<36} {:<16} {}".format("Action", "Package", "Installed",
+                                           "Snapshot"))
+    print("{}-{}-{}-{}".format("="*10, "="*36, "="*16, "="*16))
+    for action in ("install", "upgrade", "downgrade", "remove"):
+        for name, old, new in plan[action]:
+            print("{:<10} {:<36} {:<16} {}".format(action, name, old or "",
+                                                   new or ""))
+    command = snapshots.restore_command(plan, args.yes, args.noauth)
+    return perform.execute(command, root=True, log=True)
+
+
 def restart(args):
     """Restart system daemons (see LIST-DAEMONS for available daemons)"""
     command = "/usr/sbin/service {} restart".format(args.daemon)
     perform.execute(command, root=True)
 
 
+def rollback(args):
+    """Undo the last transaction recorded in the log (see LISTLOG)
+
+    Installed packages are removed, removed ones reinstalled, and
+    upgraded or downgraded ones returned to their previous version,
+    all within one apt transaction. The old versions are taken from
+    the debs saved by 'upgrade --backup', from the download cache, or
+    else from any source still offering them. An earlier transaction
+    can be chosen by its timestamp. Use --simulate to only see the plan:
+
+    $ wajig rollback --simulate
+    $ wajig rollback 2010-09-21T09:21:00
+    """
+    import rollback
+    timestamp, changes, missing = rollback.plan(args.timestamp)
+    if timestamp is None:
+        print("No logged transaction to roll back.")
+        return 1
+    for package in missing:
+        print("No previous version found, left as is:", package)
+    if not changes:
+        print("Nothing to undo for the transaction of {}.".format(timestamp))
+        return
+    print("Rolling back the transaction of {}:".format(timestamp))
+    print("{:<10} {:<28} {:<16} {:<16} {}".format(
+        "Action", "Package", "Installed", "Target", "From"))
+    print("{}-{}-{}-{}-{}".format("="*10, "="*28, "="*16, "="*16, "="*8))
+    for action, package, current, target, source in changes:
+        print("{:<10} {:<28} {:<16} {:<16} {}".format(
+            action, package, current or "", target or "", source or ""))
+    command = rollback.rollback_command(changes, args.yes, args.noauth)
+    return perform.execute(command, root=True, log=True)
+
+
 def rpm2deb(args):
     """Convert an .rpm file to a Debian .deb file"""
     command = "alien " + args.rpm
@@ -911,13 +1337,33 @@ def sizes(args):
 
     To display sizes of all packages, do not use any argument:
     $ wajig sizes
+
+    With --closure, the size freed by removing each package is shown as
+    well: that of the package and of all the packages only it keeps
+    installed, through any chain of dependencies. Without arguments the
+    manually installed packages are shown:
+    $ wajig sizes --closure
     """
-    util.sizes(args.packages)
+    if args.closure:
+        depgraph.report_sizes(args.packages)
+    else:
+        util.sizes(args.packages)
 
 
 def snapshot(args):
-    """Generates a list of package=version for all installed packages"""
-    util.do_status([], snapshot=True)
+    """Generates a list of package=version for all installed packages
+
+    Packages are listed as name:arch=version, sorted by name. A copy is
+    kept in ~/.wajig/<hostname>/Snapshot for FLEETDIFF. See RESTORE for
+    bringing a system back to a snapshot.
+    """
+    lines = snapshots.generate()
+    try:
+        for line in lines:
+            print(line)
+    except BrokenPipeError:
+        pass
+    snapshots.save(lines)
 
 
 def source(args):
@@ -949,8 +1395,8 @@ def tasksel(args):
 
 
 def todo(args):
-    """Display the TODO file of a given package"""
-    util.display_sys_docs(args.package, ["TODO"])
+    """Display the TODO file of the given packages"""
+    util.display_sys_docs(args.packages, ["TODO"])
 
 
 def toupgrade(args):
@@ -965,14 +1411,16 @@ def tutorial(args):
 
 
 def unhold(args):
-    """Remove listed packages from hold so they are again upgradeable"""
-    for package in args.packages:
-        # The dpkg needs sudo but not the echo.
-        # Do all of it as root then.
-        command = "echo \"" + package + " install\" | dpkg --set-selections"
-        perform.execute(command, root=True)
+    """Remove listed packages from hold so they are again upgradeable
+
+    Glob and regular expression patterns are matched against the held
+    packages, as with HOLD.
+    """
+    packages = util.resolve_packages(args.packages, util.held_packages())
+    util.set_selections(packages, "install")
     print("The following packages are still on hold:")
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for package in util.held_packages():
+        print(package)
 
 
 def unofficial(args):
@@ -1020,9 +1468,7 @@ def upgrade(args):
     packages = util.upgradable()
     if packages:
         if args.backup:
-            util.requires_package("dpkg-repack")
-            util.requires_package("fakeroot")
-            util.backup_before_upgrade(packages)
+            backup.backup_before_upgrade(packages, args.keep_backups)
         command = (
             "/usr/bin/apt-get {} {} {} --show-upgraded --with-new-pkgs upgrade"
         )
@@ -1054,9 +1500,21 @@ def upgradesecurity(args):
 
 
 def verify(args):
-    """Check package's md5sum"""
-    util.requires_package("debsums")
-    perform.execute("debsums " + args.package)
+    """Check the files of the given packages against their md5sums
+
+    The status of each file is shown; use --json for a machine readable
+    report. See INTEGRITY for checking all packages at once.
+    """
+    installed = util.installed_packages()
+    unknown = [package for package in args.packages
+               if package not in installed]
+    if unknown:
+        print("Not installed:", " ".join(unknown))
+        sys.exit(1)
+    results, read = checksums.check(checksums.expected(args.packages))
+    checksums.report(results, args.json)
+    if any(result[0] != checksums.OK for result in results):
+        sys.exit(1)
 
 
 def versions(args):
@@ -1072,44 +1530,104 @@ def versions(args):
 def whichpackage(args):
     """Search for files matching a given pattern within packages
 
-    Note: also searches files for uninstalled packages if apt-file is
-    installed
+    As with 'dpkg --search', an absolute path is matched exactly (or all
+    below it when it ends with / or *), a glob pattern against whole
+    paths, and anything else against the file names, or the paths when
+    it holds a /. The installed files are kept in an index that is
+    brought up to date from the changed dpkg file lists only.
+
+    Files of uninstalled packages are found in the Contents files APT
+    downloads once apt-file is installed, indexed the same way.
     """
     try:
-        output = perform.execute(
-            "dpkg --search " + args.pattern, getoutput=True
-        ).decode()
-    # 'dpkg --search' returns a failing error code if it does not find matches
-    except subprocess.CalledProcessError:
-        installed_matches = []
-    else:
-        installed_matches = output.strip().split('\n')
-        header = "INSTALLED MATCHES (x{})".format(len(installed_matches))
+        installed = fileindex.search(args.pattern)
+        if installed:
+            header = "INSTALLED MATCHES (x{})".format(len(installed))
+            print(header)
+            print('-' * len(header))
+            for path, packages in installed:
+                print("{}: {}".format(", ".join(packages), path))
+            print()
+        try:
+            matches = contentsindex.search(args.pattern)
+        except OSError as error:
+            print("Failed to read the Contents files:", error)
+            sys.exit(1)
+        if matches is None:
+            print("NOTE: install apt-file and run 'wajig update' in order to "
+                  "display uninstalled matches")
+            return
+        # The installed index names Multi-Arch: same packages with their arch.
+        installed = set((package.partition(":")[0], path)
+                        for path, packages in installed
+                        for package in packages)
+        uninstalled_matches = ["{}: {}".format(package, path)
+                               for path, packages in matches
+                               for package in packages
+                               if (package, path) not in installed]
+        header = "UNINSTALLED MATCHES (x{})".format(len(uninstalled_matches))
         print(header)
         print('-' * len(header))
-        for line in installed_matches:
+        for line in uninstalled_matches:
             print(line)
-        print()
-    if shutil.which("apt-file"):
-        try:
-            output = perform.execute(
-                "apt-file search " + args.pattern, getoutput=True
-            ).decode()
-            all_matches = output.strip()
-            if all_matches:
-                all_matches = all_matches.split('\n')
-                uninstalled_matches = set(all_matches) - set(installed_matches)
-                header = "UNINSTALLED MATCHES (x{})".format(
-                    len(uninstalled_matches)
-                )
-                print(header)
-                print('-' * len(header))
-                for line in uninstalled_matches:
-                    print(line)
-        except subprocess.CalledProcessError as error:
-            if error.returncode == 3:
-                print("Cache found empty... be sure to run 'apt-file update'")
-            else:
-                print("No results found matching '{}'".format(args.pattern))
-    else:
-        print("NOTE: install apt-file in order to display uninstalled matches")
+    except BrokenPipeError:
+        util.stdout_closed()
+
+
+def why(args):
+    """Show why an installed package is installed
+
+    The shortest chain of Depends and Recommends from a manually
+    installed package down to the given one is shown, the way 'aptitude
+    why' does; 'A' marks automatically installed packages:
+
+    $ wajig why libgpm2
+    """
+    graph = depgraph.load()
+    if args.package not in graph.numbers:
+        print("{} is not installed".format(args.package))
+        sys.exit(1)
+    chain = graph.chain(args.package)
+    if chain is None:
+        print("No manually installed package depends on or recommends {}"
+              .format(args.package))
+        sys.exit(1)
+    if not chain:
+        print("{} is manually installed".format(args.package))
+    for package, kind, target in chain:
+        flags = "i A" if graph.auto[graph.numbers[package]] else "i"
+        print("{:<4}{:<32} {:<11} {}".format(flags, package, kind, target))
+
+
+def whynot(args):
+    """Show what stands in the way of installing a package
+
+    These are the installed packages that conflict with or break the
+    package, or anything it provides, and those the package itself
+    conflicts with or breaks.
+    """
+    graph = depgraph.load()
+    if args.package in graph.numbers:
+        print("{} is installed".format(args.package))
+        return
+    provides, conflicts = [], []
+    package = util.get_cache().get(args.package)
+    if package is not None and package.candidate is not None:
+        provides = package.candidate.provides
+        for dependency in package.candidate.get_dependencies(
+                *depgraph.CONFLICT_FIELDS):
+            for alternative in dependency.or_dependencies:
+                relation = alternative.name
+                if alternative.version:
+                    relation += " ({} {})".format(alternative.relation,
+                                                  alternative.version)
+                conflicts.append((dependency.rawtype, alternative.name,
+                                  relation))
+    relations = graph.conflicting(args.package, provides, conflicts)
+    if not relations:
+        print("No installed package stands in the way of {}".format(
+            args.package))
+        return
+    for package, field, target in relations:
+        flags = "i" if package in graph.numbers else "p"
+        print("{:<4}{:<32} {:<11} {}".format(flags, package, field, target))
@@ -0,0 +1,184 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Which package, installed or not, ships a file.
+
+With apt-file installed, 'apt update' also downloads the Contents-<arch>
+files of each source into /var/lib/apt/lists, compressed with lz4, gzip
+or xz. They are decompressed here as they are read and merged into a
+path index (see pathindex) in ~/.wajig/<hostname>/ContentsIndex, which
+is rebuilt only when the Contents files change, so a search is a lookup
+rather than a decompress-and-grep of every file."""
+
+import gzip
+import heapq
+import io
+import itertools
+import lzma
+import os
+import shutil
+import subprocess
+import tempfile
+
+import apt_pkg
+
+import pathindex
+import util
+
+# How many entries of unsorted Contents files are sorted in memory at once.
+RUN = 1000000
+
+
+def contents_files():
+    """Return the Contents files of the binary packages APT fetched"""
+    lists_dir = apt_pkg.config.find_dir("Dir::State::lists")
+    try:
+        names = os.listdir(lists_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(os.path.join(lists_dir, name) for name in names
+                  if "_Contents-" in name and "_Contents-udeb" not in name
+                  and os.path.isfile(os.path.join(lists_dir, name)))
+
+
+class ToolReader(io.RawIOBase):
+    """The output of a decompressing COMMAND; reaching its end raises
+    OSError if the command failed"""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.process.stdout.readinto(buffer)
+        if not count and self.process.wait():
+            raise OSError("{} exited with status {}".format(
+                " ".join(self.command), self.process.returncode))
+        return count
+
+    def close(self):
+        if not self.closed:
+            # Stopping early leaves the tool to die of SIGPIPE.
+            self.process.stdout.close()
+            self.process.wait()
+        super().close()
+
+
+def open_contents(path):
+    """Open a Contents file for reading, decompressing it on the fly"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    if path.endswith(".xz"):
+        return lzma.open(path, "rb")
+    if path.endswith(".lz4"):
+        try:
+            import lz4.frame
+        except ImportError:
+            # Without python3-lz4, stream through the lz4 tool instead.
+            if not shutil.which("lz4"):
+                raise OSError("reading {} needs python3-lz4 or lz4".format(
+                    os.path.basename(path)))
+            return io.BufferedReader(ToolReader(["lz4", "-dc", path]))
+        return lz4.frame.open(path, "rb")
+    return open(path, "rb")
+
+
+def read_contents(path):
+    """Yield (path, package) for each line of a Contents file
+
+    Each line holds a path, relative to /, and after the last run of
+    spaces a comma separated list of section/package locations."""
+    with open_contents(path) as f:
+        for line in f:
+            fields = line.rstrip().rsplit(None, 1)
+            # Skip the free text header of old style Contents files.
+            if len(fields) != 2 or b"/" not in fields[1]:
+                continue
+            name = b"/" + fields[0]
+            packages = set(location.rsplit(b"/", 1)[-1].decode()
+                           for location in fields[1].split(b","))
+            for package in sorted(packages):
+                yield name, package
+
+
+def read_run(run):
+    for line in run:
+        path, package = line[:-1].split(b"\0")
+        yield path, package.decode()
+
+
+def external_sort(entries):
+    """Yield the (path, package) ENTRIES in order, for Contents files that
+    are not sorted; runs of RUN entries are sorted in memory and written
+    to temporary files, which are then merged"""
+    runs = list()
+    try:
+        chunk = list(itertools.islice(entries, RUN))
+        while chunk:
+            chunk.sort()
+            run = tempfile.TemporaryFile(
+                dir=os.path.dirname(util.contents_index))
+            runs.append(run)
+            # Neither paths nor package names hold a NUL or a newline.
+            for path, package in chunk:
+                run.write(path + b"\0" + package.encode() + b"\n")
+            run.seek(0)
+            chunk = list(itertools.islice(entries, RUN))
+        for entry in heapq.merge(*(read_run(run) for run in runs)):
+            yield entry
+    finally:
+        for run in runs:
+            run.close()
+
+
+def load():
+    """Return the index of the Contents files, rebuilding it if needed,
+    or None if APT has downloaded none"""
+    files = contents_files()
+    if not files:
+        return None
+    current = dict((path, list(util.file_fingerprint(path)[1:]))
+                   for path in files)
+    try:
+        index = pathindex.PathIndex(util.contents_index)
+    except (OSError, ValueError):
+        pass
+    else:
+        if index.meta == current:
+            return index
+        index.close()
+    # The Contents files are sorted by path, so they merge as they stream.
+    entries = heapq.merge(*(read_contents(path) for path in files))
+    try:
+        pathindex.write(util.contents_index, current, entries)
+    except ValueError:
+        entries = itertools.chain.from_iterable(read_contents(path)
+                                                for path in files)
+        pathindex.write(util.contents_index, current, external_sort(entries))
+    return pathindex.PathIndex(util.contents_index)
+
+
+def search(pattern):
+    """Return (path, packages) for all the files matching PATTERN, or
+    None when there are no Contents files to search"""
+    index = load()
+    if index is None:
+        return None
+    try:
+        return pathindex.grouped(index.search(pattern))
+    finally:
+        index.close()
+
+
+def package_files(package):
+    """Return the files of a package, or None without Contents files"""
+    index = load()
+    if index is None:
+        return None
+    try:
+        return [path.decode(errors="replace")
+                for path, name in index.package_entries(package)]
+    finally:
+        index.close()
@@ -0,0 +1,264 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Read .deb files without dpkg-deb or temporary files.
+
+A .deb is an ar archive holding debian-binary, control.tar and
+data.tar, the tar members being compressed with gzip, xz, bzip2 or
+zstd (or not at all). The members are streamed straight from the .deb
+through the decompressor and the tar reader, so looking at one file of
+a package reads only as far into the archive as that file, and reading
+the control information never touches data.tar. Without a Python
+module for zstd the zstd tool is used instead."""
+
+import bz2
+import collections
+import contextlib
+import gzip
+import io
+import lzma
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+
+SCRIPTS = ("preinst", "postinst", "prerm", "postrm")
+
+
+class DebError(Exception):
+    pass
+
+
+# What reading a damaged or truncated .deb may raise.
+READ_ERRORS = (DebError, OSError, EOFError, ValueError, tarfile.TarError,
+               lzma.LZMAError, zlib.error)
+
+
+class ArMember(io.RawIOBase):
+    """The bytes of one ar member, read in place from the archive"""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.left:
+            return 0
+        view = memoryview(buffer)[:min(len(buffer), self.left)]
+        count = self.f.readinto(view)
+        self.left -= count
+        return count
+
+
+def ar_members(f):
+    """Yield the name and size of each ar member, leaving F at its data"""
+    if f.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise DebError("not a Debian package")
+    position = len(AR_MAGIC)
+    while True:
+        f.seek(position)
+        header = f.read(AR_HEADER_SIZE)
+        if len(header) < AR_HEADER_SIZE:
+            return
+        name = header[:16].decode().strip().rstrip("/")
+        size = int(header[48:58])
+        yield name, size
+        # Members are aligned on even offsets.
+        position += AR_HEADER_SIZE + size + (size & 1)
+
+
+class ToolReader(io.RawIOBase):
+    """The output of a decompressing COMMAND, fed STREAM by a thread"""
+
+    def __init__(self, command, stream):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self.feed, args=(stream,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self, stream):
+        try:
+            shutil.copyfileobj(stream, self.process.stdin)
+            self.process.stdin.close()
+        except OSError:
+            # The reader stopped early and the tool has gone.
+            pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.process.stdout.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            self.process.stdout.close()
+            self.thread.join()
+            self.process.wait()
+        super().close()
+
+
+def decompressor(name, stream):
+    """Wrap STREAM to decompress the member NAME according to its suffix"""
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+    if name.endswith(".xz"):
+        return lzma.LZMAFile(stream)
+    if name.endswith(".bz2"):
+        return bz2.BZ2File(stream)
+    if name.endswith(".zst"):
+        try:
+            # Part of the standard library from Python 3.14.
+            from compression import zstd
+            return zstd.ZstdFile(stream)
+        except ImportError:
+            pass
+        try:
+            import zstandard
+        except ImportError:
+            # Without python3-zstandard, stream through the zstd tool.
+            if not shutil.which("zstd"):
+                raise DebError("reading {} needs python3-zstandard or "
+                               "zstd".format(name))
+            return io.BufferedReader(ToolReader(["zstd", "-dc"], stream))
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+@contextlib.contextmanager
+def open_tar(path, prefix):
+    """Open the PREFIX (control.tar or data.tar) member of a .deb as a
+    tar stream, to be read once from start to end"""
+    with open(path, "rb") as f:
+        for name, size in ar_members(f):
+            if name.startswith(prefix):
+                stream = io.BufferedReader(ArMember(f, size))
+                with decompressor(name, stream) as data:
+                    with tarfile.open(fileobj=data, mode="r|") as tar:
+                        yield tar
+                return
+    raise DebError("{} has no {} member".format(path, prefix))
+
+
+def member_path(member):
+    """Return the path of a tar member without its leading ./"""
+    name = member.name
+    if name.startswith("./"):
+        name = name[2:]
+    return name.lstrip("/")
+
+
+Control = collections.namedtuple("Control", "format size control_size files")
+
+
+def read_control(path):
+    """Return the format, the size of the .deb and of its control.tar, and
+    a dict of the name of each control file to its mode and contents
+
+    Only debian-binary and control.tar are read; data.tar, however large,
+    is skipped over."""
+    version = None
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        for name, member_size in ar_members(f):
+            if name == "debian-binary":
+                version = f.read(member_size).decode().strip()
+            elif name.startswith("control.tar"):
+                files = dict()
+                stream = io.BufferedReader(ArMember(f, member_size))
+                with decompressor(name, stream) as data:
+                    with tarfile.open(fileobj=data, mode="r|") as tar:
+                        for member in tar:
+                            if member.isfile():
+                                files[member_path(member)] = (
+                                    member.mode,
+                                    tar.extractfile(member).read())
+                return Control(version, size, member_size, files)
+    raise DebError("{} has no control.tar member".format(path))
+
+
+def fields(control):
+    """Return the fields of the control file as an ordered dict, the lines
+    continuing a field being kept with their leading space"""
+    result = collections.OrderedDict()
+    field = None
+    text = control.files.get("control", (0, b""))[1]
+    for line in text.decode(errors="replace").splitlines():
+        if line[:1] in (" ", "\t") and field is not None:
+            result[field] += "\n" + line
+        elif ":" in line:
+            field, value = line.split(":", 1)
+            result[field] = value.strip()
+    return result
+
+
+def info_lines(control):
+    """Yield the lines 'dpkg-deb --info' shows for a .deb"""
+    yield " new Debian package, version {}.".format(control.format)
+    yield " size {} bytes: control archive={} bytes.".format(
+        control.size, control.control_size)
+    for name in sorted(control.files):
+        mode, data = control.files[name]
+        interpreter = ""
+        if data.startswith(b"#!"):
+            interpreter = data.split(b"\n", 1)[0].decode(errors="replace")
+        yield " {:7} bytes, {:5} lines   {}  {:20} {}".format(
+            len(data), data.count(b"\n"), "*" if mode & 0o111 else " ",
+            name, interpreter).rstrip()
+    text = control.files.get("control", (0, b""))[1]
+    for line in text.decode(errors="replace").splitlines():
+        yield " " + line
+
+
+Entry = collections.namedtuple("Entry", "mode owner size mtime name target")
+
+
+def member_entry(member):
+    """Return what a listing shows of a tar member as an Entry"""
+    if member.isdir():
+        kind = stat.S_IFDIR
+    elif member.issym():
+        kind = stat.S_IFLNK
+    elif member.ischr():
+        kind = stat.S_IFCHR
+    elif member.isblk():
+        kind = stat.S_IFBLK
+    elif member.isfifo():
+        kind = stat.S_IFIFO
+    else:
+        kind = stat.S_IFREG
+    mode = stat.filemode(kind | member.mode)
+    if member.islnk():
+        mode = "h" + mode[1:]
+    owner = "{}/{}".format(member.uname or member.uid,
+                           member.gname or member.gid)
+    name = member.name
+    if member.isdir() and not name.endswith("/"):
+        name += "/"
+    target = member.linkname if member.issym() or member.islnk() else None
+    return Entry(mode, owner, member.size, int(member.mtime), name, target)
+
+
+def listing(entry):
+    """Return the line 'tar --list --verbose' shows for an Entry"""
+    size = str(entry.size)
+    # Like tar, keep owner and size at least 19 columns wide together.
+    width = max(19 - len(entry.owner), len(size) + 1)
+    name = entry.name
+    if entry.mode.startswith("l"):
+        name += " -> " + entry.target
+    elif entry.mode.startswith("h"):
+        name += " link to " + entry.target
+    return "{} {}{:>{}} {} {}".format(
+        entry.mode, entry.owner, size, width,
+        time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.mtime)), name)
@@ -0,0 +1,287 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Inspect many package files (.deb) at once.
+
+Files may be given one by one, as directories holding them, or as glob
+patterns. They are read in parallel by a pool of processes, and what
+was read of each is kept in ~/.wajig/<hostname>/DebCache under its
+path, size and modification time, so looking again at a mostly
+unchanged set of files reads only the new and changed ones. The file
+listing and the sha256 of a file are only read when first asked for.
+
+Results come out in the order of the files as soon as they are ready,
+one table row, or one JSON object per line, for each file."""
+
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+import debreader
+import util
+
+cache_file = os.path.join(util.init_dir, "DebCache")
+
+INFO = "info"
+DESCRIBE = "describe"
+CONTENTS = "contents"
+
+
+def is_pattern(argument):
+    return any(c in argument for c in "*?[")
+
+
+def is_file_argument(argument):
+    """Whether an argument stands for package files rather than a name"""
+    return argument.endswith(".deb") or is_pattern(argument) or \
+        os.path.isdir(argument)
+
+
+def bulk(arguments):
+    """Whether ARGUMENTS may stand for more than one package file"""
+    return len(arguments) > 1 or any(is_pattern(argument) or
+                                     os.path.isdir(argument)
+                                     for argument in arguments)
+
+
+def expand(arguments):
+    """Return the package files given by ARGUMENTS, searching directories
+    for .deb files, and the patterns that matched none"""
+    paths = list()
+    unmatched = list()
+    for argument in arguments:
+        if is_pattern(argument):
+            matches = sorted(glob.glob(argument))
+        else:
+            matches = [argument]
+        found = len(paths)
+        for match in matches:
+            if os.path.isdir(match):
+                for directory, subdirectories, files in os.walk(match):
+                    subdirectories.sort()
+                    paths.extend(os.path.join(directory, name)
+                                 for name in sorted(files)
+                                 if name.endswith(".deb"))
+            elif match.endswith(".deb") or match == argument:
+                paths.append(match)
+        if len(paths) == found:
+            unmatched.append(argument)
+    return paths, unmatched
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def new_record():
+    return dict(format=None, size=None, control_size=None, fields=[],
+                scripts=[], files=None, sha256=None, error=None)
+
+
+def complete(record, files, sha256):
+    """Whether RECORD holds all that was asked for"""
+    if record is None:
+        return False
+    if record["error"] is not None:
+        return True
+    return (not files or record["files"] is not None) and \
+        (not sha256 or record["sha256"] is not None)
+
+
+def read_deb(path, record, files, sha256):
+    """Return RECORD, or a new record if None, completed with what is
+    asked for of the package file at PATH"""
+    if record is None:
+        record = new_record()
+        try:
+            control = debreader.read_control(path)
+        except debreader.READ_ERRORS as e:
+            record["error"] = str(e)
+            return record
+        record["format"] = control.format
+        record["size"] = control.size
+        record["control_size"] = control.control_size
+        record["fields"] = list(debreader.fields(control).items())
+        record["scripts"] = [script for script in debreader.SCRIPTS
+                             if script in control.files]
+    try:
+        if files and record["files"] is None:
+            with debreader.open_tar(path, "data.tar") as tar:
+                record["files"] = [debreader.member_entry(member)
+                                   for member in tar]
+        if sha256 and record["sha256"] is None:
+            record["sha256"] = sha256_file(path)
+    except debreader.READ_ERRORS as e:
+        record["error"] = str(e)
+    return record
+
+
+def load_cache():
+    try:
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return dict()
+
+
+def save_cache(cache):
+    # Forget the files that have gone.
+    cache = dict((path, value) for path, value in cache.items()
+                 if os.path.exists(path))
+    temporary_file = tempfile.mkstemp(dir=util.init_dir)[1]
+    with open(temporary_file, "wb") as f:
+        pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file, cache_file)
+
+
+def scan(paths, files=False, sha256=False):
+    """Yield (path, record) for each of PATHS in order, reading the files
+    not found in the cache in parallel"""
+    cache = load_cache()
+    jobs = list()
+    for path in paths:
+        try:
+            info = os.stat(path)
+        except OSError as e:
+            record = new_record()
+            record["error"] = e.strerror
+            jobs.append((path, None, record))
+            continue
+        key = (os.path.abspath(path), info.st_size, info.st_mtime_ns)
+        cached_key, record = cache.get(key[0], (None, None))
+        if cached_key != key:
+            record = None
+        jobs.append((path, key, record))
+    pending = [(path, record) for path, key, record in jobs
+               if key is not None and not complete(record, files, sha256)]
+    pool = None
+    if len(pending) > 1:
+        pool = concurrent.futures.ProcessPoolExecutor()
+        futures = [pool.submit(read_deb, path, record, files, sha256)
+                   for path, record in pending]
+        results = iter(futures)
+    try:
+        for path, key, record in jobs:
+            if key is not None and not complete(record, files, sha256):
+                if pool is None:
+                    record = read_deb(path, record, files, sha256)
+                else:
+                    record = next(results).result()
+                cache[key[0]] = (key, record)
+            yield path, record
+    finally:
+        if pool is not None:
+            # Drop the work left when stopped early, as by closed output.
+            for future in futures:
+                future.cancel()
+            pool.shutdown()
+        if pending:
+            save_cache(cache)
+
+
+def summary(fields):
+    return fields.get("Description", "").split("\n", 1)[0]
+
+
+def as_object(path, record, what, sha256, verbose):
+    fields = collections.OrderedDict(record["fields"])
+    result = collections.OrderedDict(file=path)
+    if record["error"] is not None:
+        result["error"] = record["error"]
+        return result
+    result["package"] = fields.get("Package")
+    result["version"] = fields.get("Version")
+    result["architecture"] = fields.get("Architecture")
+    if what == INFO:
+        result["size"] = record["size"]
+        if sha256:
+            result["sha256"] = record["sha256"]
+        result["control"] = fields
+        result["scripts"] = record["scripts"]
+    elif what == DESCRIBE:
+        if verbose:
+            result["description"] = fields.get("Description", "")
+        else:
+            result["summary"] = summary(fields)
+    else:
+        result["files"] = [entry._asdict() for entry in record["files"]]
+    return result
+
+
+def rows(path, record, what, sha256, verbose):
+    """Yield the table lines of one package file"""
+    fields = dict(record["fields"])
+    if what == INFO:
+        columns = [fields.get("Package", ""), fields.get("Version", ""),
+                   fields.get("Architecture", ""),
+                   util.human_size(record["size"])]
+        if sha256:
+            columns.append(record["sha256"])
+        yield table_row(columns + [path])
+    elif what == DESCRIBE:
+        if verbose:
+            yield "{}: {}\n".format(fields.get("Package", path),
+                                    fields.get("Description", ""))
+        else:
+            yield "{:24} {}".format(fields.get("Package", path),
+                                    summary(fields))
+    else:
+        for entry in record["files"]:
+            yield "{}: {}".format(path, debreader.listing(entry))
+
+
+def table_row(columns):
+    return " ".join(["{:24} {:20} {:12} {:>8}".format(*columns[:4])] +
+                    columns[4:])
+
+
+def header(what, sha256, verbose):
+    if what == INFO:
+        columns = ["Package", "Version", "Architecture", "Size"]
+        if sha256:
+            columns.append("{:64}".format("SHA256"))
+        yield table_row(columns + ["File"])
+        yield "=" * 24 + "-" + "=" * 20 + "-" + "=" * 12 + "-" + "=" * 8 + \
+            "-" + "=" * (72 if sha256 else 8)
+    elif what == DESCRIBE and not verbose:
+        yield "{:24} {}".format("Package", "Description")
+        yield "=" * 24 + "-" + "=" * 51
+
+
+def report(arguments, what, as_json=False, sha256=False, verbose=False):
+    """Show WHAT (INFO, DESCRIBE or CONTENTS) of the package files given
+    by ARGUMENTS, as a table or as one JSON object per line, and return
+    the number of files, or patterns matching none, that failed"""
+    paths, unmatched = expand(arguments)
+    for argument in unmatched:
+        print("{}: no package files found".format(argument), file=sys.stderr)
+    failed = len(unmatched)
+    try:
+        if not as_json:
+            for line in header(what, sha256, verbose):
+                print(line)
+        for path, record in scan(paths, what == CONTENTS, sha256):
+            if as_json:
+                print(json.dumps(as_object(path, record, what, sha256,
+                                           verbose)))
+            elif record["error"] is not None:
+                sys.stdout.flush()
+                print("{}: {}".format(path, record["error"]),
+                      file=sys.stderr)
+            else:
+                for line in rows(path, record, what, sha256, verbose):
+                    print(line)
+            if record["error"] is not None:
+                failed += 1
+    except BrokenPipeError:
+        util.stdout_closed()
+    return failed
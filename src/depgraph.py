@@ -0,0 +1,414 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""The dependencies among installed packages, and the orphans they leave.
+
+Dependencies are read from the dpkg status. A dependency on a virtual
+package counts for every installed package providing it, and one of a
+group of alternatives for every installed alternative, so that nothing
+anything might be using is taken for unused. Versions are not looked
+at: an installed package satisfies, or is meant to satisfy, what
+depends on it.
+
+The graph is kept in flat arrays, compressed sparse row fashion: the
+packages are numbered, and the edges of package N are those from
+offsets[N] to offsets[N + 1] in targets and kinds. It is stored in
+~/.wajig/<hostname>/DepGraph along with the reverse edges, and built
+again only once the dpkg status or APT's auto-installed marks change."""
+
+import array
+import collections
+import os
+import pickle
+import tempfile
+
+import apt_pkg
+
+import util
+
+# The kinds of edge, strongest first; two packages related in several
+# ways are joined by a single edge of the strongest kind.
+DEPENDS = 0
+RECOMMENDS = 1
+SUGGESTS = 2
+KIND_FIELDS = (
+    (DEPENDS, ("Pre-Depends", "Depends")),
+    (RECOMMENDS, ("Recommends",)),
+    (SUGGESTS, ("Suggests",)),
+)
+KIND_NAMES = ("Depends", "Recommends", "Suggests")
+CONFLICT_FIELDS = ("Conflicts", "Breaks")
+
+LIBRARY_SECTIONS = ("libs", "oldlibs")
+
+
+def alternatives(text):
+    """Yield (package name, relation) for each relation of a dependency
+    field, the name stripped of any architecture qualifier"""
+    for group in text.split(","):
+        for alternative in group.split("|"):
+            words = alternative.split()
+            if words:
+                yield words[0].split("(")[0].split(":")[0], \
+                    " ".join(words)
+
+
+def relations(text):
+    """Return the package names of a dependency field, ignoring versions,
+    architecture qualifiers and how they are grouped in alternatives"""
+    return [name for name, relation in alternatives(text)]
+
+
+def section(entry):
+    """Return the section of a status entry without its archive area"""
+    return entry.get("Section", "").rsplit("/", 1)[-1]
+
+
+def providers(installed):
+    """Return a dict of package name, real or virtual, to the installed
+    packages (named as read_status() names them) answering to it"""
+    provided = collections.defaultdict(set)
+    for name, entry in installed.items():
+        provided[entry["Package"]].add(name)
+        for virtual in relations(entry.get("Provides", "")):
+            provided[virtual].add(name)
+    return provided
+
+
+def state_key():
+    extended_states = apt_pkg.config.find_file("Dir::State::extended_states")
+    return [util.file_fingerprint(util.status_file),
+            util.file_fingerprint(extended_states)]
+
+
+def reverse(count, offsets, targets, kinds):
+    """Return the offsets, sources and kinds of the reversed edges"""
+    degrees = [0] * (count + 1)
+    for target in targets:
+        degrees[target + 1] += 1
+    for number in range(count):
+        degrees[number + 1] += degrees[number]
+    reverse_offsets = array.array("I", degrees)
+    sources = array.array("I", [0]) * len(targets)
+    reverse_kinds = array.array("B", [0]) * len(targets)
+    for source in range(count):
+        for edge in range(offsets[source], offsets[source + 1]):
+            target = targets[edge]
+            sources[degrees[target]] = source
+            reverse_kinds[degrees[target]] = kinds[edge]
+            degrees[target] += 1
+    return reverse_offsets, sources, reverse_kinds
+
+
+def build():
+    """Return the graph of the installed packages as a dict of arrays"""
+    installed = util.installed_packages()
+    names = sorted(installed)
+    numbers = dict((name, number) for number, name in enumerate(names))
+    provided = providers(installed)
+    auto = util.auto_installed()
+    offsets = array.array("I", [0])
+    targets = array.array("I")
+    kinds = array.array("B")
+    conflicts = collections.defaultdict(list)
+    for number, name in enumerate(names):
+        entry = installed[name]
+        edges = dict()
+        for kind, fields in reversed(KIND_FIELDS):
+            for field in fields:
+                for relation in relations(entry.get(field, "")):
+                    for target in provided.get(relation, ()):
+                        edges[numbers[target]] = kind
+        edges.pop(number, None)
+        for target in sorted(edges):
+            targets.append(target)
+            kinds.append(edges[target])
+        offsets.append(len(targets))
+        for field in CONFLICT_FIELDS:
+            for target, relation in alternatives(entry.get(field, "")):
+                conflicts[target].append((number, field, relation))
+    reverse_offsets, sources, reverse_kinds = reverse(
+        len(names), offsets, targets, kinds)
+    provides = dict((virtual, [numbers[name] for name in sorted(packages)])
+                    for virtual, packages in provided.items())
+    return dict(names=names,
+                auto=array.array("B", [name in auto for name in names]),
+                offsets=offsets, targets=targets, kinds=kinds,
+                reverse_offsets=reverse_offsets, sources=sources,
+                reverse_kinds=reverse_kinds, provides=provides,
+                conflicts=dict(conflicts))
+
+
+class Graph:
+    """The dependency graph of the installed packages"""
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+        self.numbers = dict((name, number)
+                            for number, name in enumerate(self.names))
+
+    def edges(self, number, strongest=SUGGESTS):
+        """Yield (package number, kind) of what package NUMBER depends on"""
+        for edge in range(self.offsets[number], self.offsets[number + 1]):
+            if self.kinds[edge] <= strongest:
+                yield self.targets[edge], self.kinds[edge]
+
+    def users(self, number, strongest=SUGGESTS):
+        """Yield (package number, kind) of what depends on package NUMBER"""
+        for edge in range(self.reverse_offsets[number],
+                          self.reverse_offsets[number + 1]):
+            if self.reverse_kinds[edge] <= strongest:
+                yield self.sources[edge], self.reverse_kinds[edge]
+
+    def chain(self, name, strongest=RECOMMENDS):
+        """Return the shortest chain of (package, kind, package) edges
+        from a manually installed package down to NAME, [] when NAME is
+        itself manually installed, or None when there is no such chain
+
+        At each step Depends are followed before Recommends."""
+        start = self.numbers[name]
+        if not self.auto[start]:
+            return []
+        via = {start: None}
+        level = [start]
+        while level:
+            following = list()
+            for number in level:
+                for user, kind in sorted(self.users(number, strongest),
+                                         key=lambda edge: edge[1]):
+                    if user in via:
+                        continue
+                    via[user] = (number, kind)
+                    if not self.auto[user]:
+                        return self.path(user, via)
+                    following.append(user)
+            level = following
+        return None
+
+    def path(self, number, via):
+        result = list()
+        while via[number] is not None:
+            target, kind = via[number]
+            result.append((self.names[number], KIND_NAMES[kind],
+                           self.names[target]))
+            number = target
+        return result
+
+    def conflicting(self, name, provides=(), conflicts=()):
+        """Return the (package, field, package) relations standing in the
+        way of installing NAME, which PROVIDES other names and has the
+        (field, package name, relation) CONFLICTS: installed packages
+        that conflict with or break it, and installed packages it
+        conflicts with or breaks
+
+        Versions are not compared, the relations being shown as they are
+        written for judging whether they apply."""
+        result = list()
+        for provided in [name] + list(provides):
+            for number, field, relation in self.conflicts.get(provided, ()):
+                result.append((self.names[number], field, relation))
+        for field, target, relation in conflicts:
+            for number in self.provides.get(target, ()):
+                installed = self.names[number]
+                if relation != installed:
+                    installed += " [{}]".format(relation)
+                result.append((name, field, installed))
+        return result
+
+    def dominators(self, roots):
+        """Return the immediate dominator of each package and the packages
+        reached in postorder, following every kind of edge from ROOTS
+
+        A package dominates another when every chain from the roots down
+        to the other goes through it: removing it leaves the other
+        unused. The roots hang from a virtual package numbered after the
+        last, and packages not reached have None for dominator. This is
+        the iterative algorithm of Cooper, Harvey and Kennedy."""
+        top = len(self.names)
+
+        def successors(number):
+            if number == top:
+                return iter(roots)
+            return (target for target, kind in self.edges(number))
+
+        # Number the packages in postorder by a depth first search.
+        postorder = list()
+        position = [None] * (top + 1)
+        seen = bytearray(top + 1)
+        seen[top] = 1
+        stack = [(top, successors(top))]
+        while stack:
+            number, children = stack[-1]
+            for child in children:
+                if not seen[child]:
+                    seen[child] = 1
+                    stack.append((child, successors(child)))
+                    break
+            else:
+                stack.pop()
+                position[number] = len(postorder)
+                postorder.append(number)
+
+        def intersect(one, other):
+            while one != other:
+                while position[one] < position[other]:
+                    one = dominator[one]
+                while position[other] < position[one]:
+                    other = dominator[other]
+            return one
+
+        is_root = set(roots)
+        dominator = [None] * (top + 1)
+        dominator[top] = top
+        changed = True
+        while changed:
+            changed = False
+            for number in reversed(postorder[:-1]):
+                users = [user for user, kind in self.users(number)]
+                if number in is_root:
+                    users.append(top)
+                new = None
+                for user in users:
+                    if dominator[user] is not None:
+                        new = user if new is None else intersect(user, new)
+                if dominator[number] != new:
+                    dominator[number] = new
+                    changed = True
+        return dominator, postorder[:-1]
+
+    def recommended(self):
+        """Return the automatically installed packages that are only
+        recommended by installed packages, not depended on"""
+        result = list()
+        for number, name in enumerate(self.names):
+            if not self.auto[number]:
+                continue
+            kinds = set(kind for user, kind in self.users(number, RECOMMENDS))
+            if RECOMMENDS in kinds and DEPENDS not in kinds:
+                result.append(name)
+        return result
+
+
+def save(data):
+    temporary_file = tempfile.mkstemp(dir=util.init_dir)[1]
+    with open(temporary_file, "wb") as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file, util.dep_graph)
+
+
+def load():
+    """Return the graph of the installed packages, building it if needed"""
+    key = state_key()
+    try:
+        with open(util.dep_graph, "rb") as f:
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        data = None
+    if data is None or data.get("key") != key:
+        data = build()
+        data["key"] = key
+        save(data)
+    return Graph(data)
+
+
+def find_orphans(all_sections=False, auto_only=False):
+    """Return the sorted installed packages nothing installed depends on
+
+    Only libraries are considered unless ALL_SECTIONS is true, and with
+    AUTO_ONLY only packages APT marked as automatically installed.
+    Essential and required packages are never orphans. Once a package
+    is found to be an orphan, what it alone kept is looked at again, so
+    a chain of libraries left by a removed program is found at once."""
+    installed = util.installed_packages()
+    graph = load()
+
+    def candidate(number):
+        entry = installed[graph.names[number]]
+        if entry.get("Essential") == "yes" or \
+           entry.get("Priority") == "required":
+            return False
+        if not all_sections and section(entry) not in LIBRARY_SECTIONS:
+            return False
+        return not auto_only or graph.auto[number]
+
+    # Count the installed packages depending on each package, and take
+    # away those found to be orphans until no more are found.
+    users = [graph.reverse_offsets[number + 1] - graph.reverse_offsets[number]
+             for number in range(len(graph.names))]
+    pending = [number for number in range(len(graph.names))
+               if not users[number] and candidate(number)]
+    found = set(pending)
+    while pending:
+        for number, kind in graph.edges(pending.pop()):
+            users[number] -= 1
+            if not users[number] and number not in found and \
+               candidate(number):
+                found.add(number)
+                pending.append(number)
+    return sorted(graph.names[number] for number in found)
+
+
+def removal_sizes():
+    """Return a dict of each installed package to its installed size, the
+    size freed by removing it and all that only it keeps installed, and
+    the number of packages removed that way; sizes are in KB as dpkg
+    gives them"""
+    installed = util.installed_packages()
+    graph = load()
+    own = [int(installed[name].get("Installed-Size", 0) or 0)
+           for name in graph.names]
+    # What is essential or required is kept whatever is removed, and so
+    # is what nothing depends on, even if automatically installed.
+    def kept(number):
+        entry = installed[graph.names[number]]
+        return not graph.auto[number] or entry.get("Essential") == "yes" or \
+            entry.get("Priority") == "required" or \
+            not any(graph.users(number))
+
+    roots = [number for number in range(len(graph.names)) if kept(number)]
+    dominator, postorder = graph.dominators(roots)
+    top = len(graph.names)
+    freed = list(own)
+    removed = [1] * top
+    # Each package comes after all it dominates, so its totals are
+    # complete when added to its own dominator.
+    for number in postorder:
+        parent = dominator[number]
+        if parent != top:
+            freed[parent] += freed[number]
+            removed[parent] += removed[number]
+    # Only packages in a cycle of automatically installed packages are
+    # not reached; they are left with just their own size.
+    return dict((name, (own[number], freed[number], removed[number]))
+                for number, name in enumerate(graph.names))
+
+
+def report_sizes(packages=None, size=0):
+    """Print the sizes freed by removing PACKAGES, by default the manually
+    installed ones, when more than SIZE KB"""
+    sizes = removal_sizes()
+    if packages:
+        unknown = [package for package in packages if package not in sizes]
+        if unknown:
+            print("Not installed:", " ".join(unknown))
+        packages = [package for package in packages if package in sizes]
+    else:
+        auto = util.auto_installed()
+        packages = [package for package in sizes if package not in auto]
+    packages = [package for package in packages if sizes[package][1] > size]
+    if not packages:
+        if size:
+            print("No packages of >{}MB size found".format(size // 1000))
+        else:
+            print("No packages found")
+        return
+    packages.sort(key=lambda package: sizes[package][1])
+    try:
+        print("{:<33} {:>10} {:>12} {:>9}".format(
+            "Package", "Size (KB)", "Freed (KB)", "Packages"))
+        print("{}-{}-{}-{}".format("="*33, "="*10, "="*12, "="*9))
+        for package in packages:
+            own, freed, removed = sizes[package]
+            print("{:<33} {:>10} {:>12} {:>9}".format(
+                package, format(own, ",d"), format(freed, ",d"), removed))
+    except BrokenPipeError:
+        util.stdout_closed()
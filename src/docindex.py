@@ -0,0 +1,176 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Full-text index of the README, NEWS and changelog files of packages.
+
+The files under /usr/share/doc/<package>/ that README, NEWS and TODO
+display, and the changelogs, plain or gzipped, are split into words and
+an inverted index of word to the files holding it (and how often) is
+kept in the SQLite database ~/.wajig/<hostname>/DocIndex.db. A search
+reads only the postings of the words asked for. Each file is remembered
+by its inode, size and modification time, so after an upgrade only the
+changed documents are read again and only their postings rewritten."""
+
+import collections
+import concurrent.futures
+import gzip
+import math
+import os
+import re
+import sqlite3
+
+import util
+
+doc_dir = "/usr/share/doc"
+index_file = os.path.join(util.init_dir, "DocIndex.db")
+
+PREFIXES = ("README", "NEWS", "TODO", "USAGE", "changelog")
+
+# Words, including package names and versions like libc6 or 2.31-13.
+WORD = re.compile(r"\w[\w.+-]*\w|\w")
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+
+def read_doc(path):
+    """Return the text of a plain or gzipped document"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return f.read().decode("utf-8", errors="replace")
+
+
+def tokenise(path):
+    """Return how many times each word occurs in a document"""
+    try:
+        return collections.Counter(words(read_doc(path)))
+    except (OSError, EOFError):
+        return collections.Counter()
+
+
+def documents():
+    """Return a dict of each indexable document to its fingerprint"""
+    found = dict()
+    try:
+        packages = list(os.scandir(doc_dir))
+    except FileNotFoundError:
+        return found
+    for package in packages:
+        # Skip the doc directories that are links to another package's.
+        if not package.is_dir(follow_symlinks=False):
+            continue
+        try:
+            entries = list(os.scandir(package.path))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith(PREFIXES) and \
+               entry.is_file(follow_symlinks=False):
+                info = entry.stat(follow_symlinks=False)
+                found[entry.path] = (info.st_ino, info.st_size,
+                                     info.st_mtime_ns)
+    return found
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    number INTEGER PRIMARY KEY, path TEXT UNIQUE,
+    inode INTEGER, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT, number INTEGER, count INTEGER);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+CREATE INDEX IF NOT EXISTS postings_number ON postings (number);
+"""
+
+# Rebuilding the postings indexes beats updating them row by row once a
+# quarter or more of the documents change, as on the first search.
+BULK = 4
+
+
+def connect():
+    # The index used to be a single pickle that every search loaded whole.
+    try:
+        os.remove(os.path.join(util.init_dir, "DocIndex"))
+    except FileNotFoundError:
+        pass
+    db = sqlite3.connect(index_file)
+    db.executescript(SCHEMA)
+    return db
+
+
+def update():
+    """Bring the index up to date with the documents, rereading only the
+    new and changed ones, and return a connection to it"""
+    db = connect()
+    known = dict((path, (number, (inode, size, mtime)))
+                 for number, path, inode, size, mtime
+                 in db.execute("SELECT * FROM documents"))
+    current = documents()
+    stale = [(number,) for path, (number, key) in known.items()
+             if current.get(path) != key]
+    changed = [path for path, key in current.items()
+               if path not in known or known[path][1] != key]
+    if not stale and not changed:
+        return db
+    bulk = len(changed) * BULK >= len(current)
+    with db:
+        db.executemany("DELETE FROM postings WHERE number = ?", stale)
+        db.executemany("DELETE FROM documents WHERE number = ?", stale)
+        if bulk:
+            db.execute("DROP INDEX postings_term")
+            db.execute("DROP INDEX postings_number")
+        with concurrent.futures.ProcessPoolExecutor() as pool:
+            for path, counts in zip(changed, pool.map(tokenise, changed,
+                                                      chunksize=32)):
+                number = db.execute(
+                    "INSERT INTO documents (path, inode, size, mtime) "
+                    "VALUES (?, ?, ?, ?)", (path,) + current[path]).lastrowid
+                db.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    ((term, number, count) for term, count in counts.items()))
+    if bulk:
+        db.executescript(SCHEMA)
+    return db
+
+
+def search(query):
+    """Return (score, path) of the documents holding every word of the
+    query, best first, scoring each word by tf-idf"""
+    db = update()
+    try:
+        terms = set(words(query))
+        if not terms:
+            return []
+        postings = dict()
+        for term in terms:
+            postings[term] = dict(db.execute(
+                "SELECT number, count FROM postings WHERE term = ?",
+                (term,)))
+            if not postings[term]:
+                return []
+        numbers = set.intersection(*(set(counts)
+                                     for counts in postings.values()))
+        total = db.execute("SELECT count(*) FROM documents").fetchone()[0]
+        scores = collections.Counter()
+        for term, counts in postings.items():
+            weight = math.log(1 + total / len(counts))
+            for number in numbers:
+                scores[number] += (1 + math.log(counts[number])) * weight
+        hits = scores.most_common()
+        paths = dict()
+        for number, score in hits:
+            paths[number] = db.execute(
+                "SELECT path FROM documents WHERE number = ?",
+                (number,)).fetchone()[0]
+        return [(score, paths[number]) for number, score in hits]
+    finally:
+        db.close()
+
+
+def matching_lines(path, query):
+    """Yield (line number, line) for the lines of a document holding a
+    word of the query"""
+    terms = set(words(query))
+    for number, line in enumerate(read_doc(path).splitlines(), 1):
+        if terms.intersection(words(line)):
+            yield number, line
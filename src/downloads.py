@@ -0,0 +1,164 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Fetch .deb files from URLs for installation.
+
+Files are streamed to disk in chunks, several URLs at a time, and an
+interrupted transfer resumes from where it stopped. Completed files are
+kept in a content-addressed store, ~/.wajig/<hostname>/debs/<sha256>/,
+so asking for the same URL again costs nothing.
+
+The expected size and checksum of a file may be given in the URL
+fragment, as in http://example.com/c_1.0_all.deb#sha256=...&size=1234"""
+
+import concurrent.futures
+import hashlib
+import os
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import util
+
+store_dir = os.path.join(util.init_dir, "debs")
+partial_dir = os.path.join(store_dir, "partial")
+index_file = os.path.join(store_dir, "index")
+
+CHUNK_SIZE = 1 << 16
+WORKERS = 4
+ATTEMPTS = 3
+
+
+class DownloadError(Exception):
+    pass
+
+
+def filename(url):
+    """Return the name of the file a URL points to"""
+    path = urllib.parse.urlsplit(url).path
+    return os.path.basename(urllib.parse.unquote(path))
+
+
+def expected(url):
+    """Return the URL without its fragment, and the size and sha256 wanted"""
+    url, fragment = urllib.parse.urldefrag(url)
+    fields = urllib.parse.parse_qs(fragment)
+    size = fields.get("size", [None])[0]
+    sha256 = fields.get("sha256", [None])[0]
+    return url, int(size) if size else None, sha256
+
+
+def load_index():
+    """Return the URLs already fetched, mapped to their files in the store"""
+    index = dict()
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            for line in f:
+                url, sep, path = line.rstrip("\n").partition("\t")
+                path = os.path.join(store_dir, path)
+                if sep and os.path.exists(path):
+                    index[url] = path
+    return index
+
+
+def add_to_index(entries):
+    with open(index_file, "a") as f:
+        for url, path in entries:
+            f.write("{}\t{}\n".format(url, os.path.relpath(path, store_dir)))
+
+
+def transfer(url, partial):
+    """Stream URL into the PARTIAL file, resuming whatever is there"""
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", "bytes={}-".format(offset))
+    try:
+        response = urllib.request.urlopen(request)
+    except urllib.error.HTTPError as error:
+        # Range Not Satisfiable: the partial file is already complete.
+        if error.code == 416 and offset:
+            return
+        raise
+    with response:
+        # Servers (and ftp) not honouring the range send it all again.
+        mode = "ab" if getattr(response, "status", None) == 206 else "wb"
+        with open(partial, mode) as f:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+
+def checksum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fetch(url):
+    """Download one URL into the store, returning the path of the file"""
+    source, size, sha256 = expected(url)
+    key = hashlib.sha1(source.encode()).hexdigest()
+    partial = os.path.join(partial_dir, key + ".part")
+    for attempt in range(ATTEMPTS):
+        try:
+            transfer(source, partial)
+            break
+        except urllib.error.HTTPError:
+            raise
+        except (urllib.error.URLError, OSError):
+            if attempt == ATTEMPTS - 1:
+                raise
+    if size is not None and os.path.getsize(partial) != size:
+        os.remove(partial)
+        raise DownloadError("size differs from the expected {}".format(size))
+    digest = checksum(partial)
+    if sha256 and digest != sha256.lower():
+        os.remove(partial)
+        raise DownloadError("sha256 differs from the expected {}".format(
+            sha256))
+    target_dir = os.path.join(store_dir, digest)
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    target = os.path.join(target_dir, filename(source))
+    os.replace(partial, target)
+    return target
+
+
+def fetch_all(urls):
+    """Download URLs concurrently, returning the local files obtained
+
+    URLs fetched before are served from the store without any network
+    access. Failures are reported and left out of the result."""
+    if not os.path.exists(partial_dir):
+        os.makedirs(partial_dir)
+    index = load_index()
+    files = list()
+    pending = list()
+    for url in urls:
+        if url in index:
+            files.append(index[url])
+        else:
+            pending.append(url)
+    if not pending:
+        return files
+    fetched = list()
+    workers = min(WORKERS, len(pending))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(fetch, url): url for url in pending}
+        for future in concurrent.futures.as_completed(futures):
+            url = futures[future]
+            try:
+                path = future.result()
+            except urllib.error.HTTPError as error:
+                print("{}; is '{}' the correct url?".format(error.reason, url))
+            except (urllib.error.URLError, OSError, DownloadError) as error:
+                print("Failed to fetch '{}': {}".format(url, error))
+            else:
+                fetched.append((url, path))
+                files.append(path)
+    add_to_index(fetched)
+    return files
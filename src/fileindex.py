@@ -0,0 +1,91 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Which installed package ships a file.
+
+dpkg keeps the files of each installed package in
+/var/lib/dpkg/info/<package>.list and 'dpkg --search' reads all of
+them for every query. Instead they are gathered once into a path index
+(see pathindex) in ~/.wajig/<hostname>/FileIndex, noting the size and
+modification time of each .list file; when packages are installed,
+upgraded or removed only their .list files are read again."""
+
+import glob
+import os
+
+import pathindex
+import util
+
+
+def list_files():
+    """Return a dict of package to the (mtime, size) of its .list file"""
+    lists = dict()
+    try:
+        entries = list(os.scandir(util.info_dir))
+    except FileNotFoundError:
+        return lists
+    for entry in entries:
+        if entry.name.endswith(".list"):
+            info = entry.stat()
+            lists[entry.name[:-len(".list")]] = [info.st_mtime_ns,
+                                                  info.st_size]
+    return lists
+
+
+def read_list(path):
+    """Yield the paths of the files listed in a dpkg .list file"""
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.rstrip(b"\n")
+                if line:
+                    yield line
+    except FileNotFoundError:
+        return
+
+
+def package_lists(package):
+    """Return the .list files of an installed package; those of Multi-Arch:
+    same packages are named with the architecture, so there may be one
+    for each architecture installed"""
+    path = os.path.join(util.info_dir, package + ".list")
+    if os.path.exists(path) or ":" in package:
+        return [path] if os.path.exists(path) else []
+    pattern = os.path.join(util.info_dir, glob.escape(package) + ":*.list")
+    return sorted(glob.glob(pattern))
+
+
+def load():
+    """Return the index of installed files, updating it if needed"""
+    current = list_files()
+    try:
+        index = pathindex.PathIndex(util.file_index)
+    except (OSError, ValueError):
+        index = None
+    else:
+        if index.meta == current:
+            return index
+    entries = list()
+    unchanged = set()
+    if index is not None:
+        unchanged = set(package for package, key in current.items()
+                        if index.meta.get(package) == key)
+        for path, package in index.entries():
+            if package in unchanged:
+                entries.append((path, package))
+        index.close()
+    for package in current:
+        if package not in unchanged:
+            path = os.path.join(util.info_dir, package + ".list")
+            entries.extend((name, package) for name in read_list(path))
+    entries.sort()
+    pathindex.write(util.file_index, current, entries)
+    return pathindex.PathIndex(util.file_index)
+
+
+def search(pattern):
+    """Return (path, packages) for the installed files matching PATTERN"""
+    index = load()
+    try:
+        return pathindex.grouped(index.search(pattern))
+    finally:
+        index.close()
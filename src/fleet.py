@@ -0,0 +1,126 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Compare the package snapshots of many hosts.
+
+Hosts sharing a home directory each keep their latest snapshot in
+~/.wajig/<hostname>/Snapshot. These are loaded into a package by host
+matrix of small integers, one array per package with an entry per host
+indexing into a table of distinct version strings, so a thousand hosts
+with five thousand packages each fit in some twenty megabytes."""
+
+import array
+import collections
+import functools
+import os
+
+import apt_pkg
+
+import snapshots
+import util
+
+MISSING = -1
+
+
+def stored_snapshots(hosts=None):
+    """Return (host, path) for each host having a stored snapshot"""
+    base = os.path.dirname(util.init_dir)
+    if not hosts:
+        hosts = sorted(os.listdir(base))
+    stored = list()
+    for host in hosts:
+        path = os.path.join(base, host, "Snapshot")
+        if os.path.isfile(path):
+            stored.append((host, path))
+    return stored
+
+
+def build_matrix(stored):
+    """Load snapshots into a package by host matrix of version numbers
+
+    Returns the list of hosts, the table of distinct versions and a dict
+    mapping each package to an array holding, for each host in turn, the
+    index of its version or MISSING."""
+    hosts = list()
+    versions = list()
+    version_ids = dict()
+    rows = dict()
+    for column, (host, path) in enumerate(stored):
+        hosts.append(host)
+        for package, version in snapshots.read(path):
+            vid = version_ids.get(version)
+            if vid is None:
+                vid = version_ids[version] = len(versions)
+                versions.append(version)
+            row = rows.get(package)
+            if row is None:
+                row = rows[package] = array.array("i", [MISSING] * column)
+            if len(row) == column:
+                row.append(vid)
+        # Pad the packages this host does not have.
+        for row in rows.values():
+            if len(row) == column:
+                row.append(MISSING)
+    return hosts, versions, rows
+
+
+def drift(hosts, versions, rows):
+    """Yield (package, kind, version, majority, hosts) for every deviation
+
+    KIND is one of 'missing' (absent from hosts while most have it),
+    'only' (present on a minority of hosts), 'behind' or 'ahead' (a
+    version older or newer than that installed on most hosts)."""
+    compare = functools.lru_cache(maxsize=None)(apt_pkg.version_compare)
+    everywhere = len(hosts)
+    for package in sorted(rows):
+        row = rows[package]
+        counts = collections.Counter(row)
+        absent = counts.pop(MISSING, 0)
+        present = everywhere - absent
+        if absent:
+            if present * 2 >= everywhere:
+                names = [hosts[i] for i, v in enumerate(row) if v == MISSING]
+                yield package, "missing", None, None, names
+            else:
+                names = [hosts[i] for i, v in enumerate(row) if v != MISSING]
+                yield package, "only", None, None, names
+        if len(counts) < 2:
+            continue
+        majority = counts.most_common(1)[0][0]
+        for vid in sorted(counts):
+            if vid == majority:
+                continue
+            names = [hosts[i] for i, v in enumerate(row) if v == vid]
+            if compare(versions[vid], versions[majority]) < 0:
+                kind = "behind"
+            else:
+                kind = "ahead"
+            yield package, kind, versions[vid], versions[majority], names
+
+
+def report(hosts=None):
+    """Print the drift between the stored snapshots of the given hosts
+
+    Like diff, returns 0 when the hosts agree, 1 when some packages
+    drift and 2 when there is nothing to compare."""
+    stored = stored_snapshots(hosts)
+    if len(stored) < 2:
+        print("At least two hosts need a snapshot; run 'wajig snapshot' "
+              "on each of them first.")
+        return 2
+    hosts, versions, rows = build_matrix(stored)
+    drifting = set()
+    print("{:<32} {:<8} {:<36} {}".format(
+        "Package", "Drift", "Version (majority)", "Hosts"))
+    print("{}-{}-{}-{}".format("="*32, "="*8, "="*36, "="*20))
+    for package, kind, version, majority, names in drift(hosts, versions,
+                                                           rows):
+        drifting.add(package)
+        if version is None:
+            detail = ""
+        else:
+            detail = "{} ({})".format(version, majority)
+        print("{:<32} {:<8} {:<36} {}".format(
+            package, kind, detail, " ".join(names)))
+    message = "{} hosts, {} packages, {} drifting"
+    print(message.format(len(hosts), len(rows), len(drifting)))
+    return 1 if drifting else 0
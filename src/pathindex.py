@@ -0,0 +1,225 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""A sorted table of file paths and the packages shipping them.
+
+The table is written to a single file that is used through mmap, so a
+lookup reads only the pages it touches rather than loading the table:
+
+    header      magic, then the lengths of the two blocks below and the
+                number of paths
+    meta        JSON describing what the table was built from
+    packages    the package names, one per line; a package id is the
+                line number of its name
+    offsets     where each path starts in the paths block, plus its end
+    ids         the package id of each path
+    starts      where the postings of each package start, plus their end
+    postings    the path numbers of each package in turn, in path order
+    paths       the paths, sorted bytewise and concatenated
+
+A path shipped by several packages appears once for each of them."""
+
+import array
+import bisect
+import fnmatch
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+MAGIC = b"WAJIGPI2"
+HEADER = struct.Struct("<8sIII")
+
+
+def write(filename, meta, entries):
+    """Write the table of (path bytes, package name) ENTRIES to FILENAME
+
+    The entries must come sorted, and are written as they come so that
+    even tables of millions of paths need little memory; duplicates are
+    skipped and ValueError is raised for entries out of order."""
+    ids = dict()
+    packages = list()
+    offsets = array.array("I", [0])
+    package_ids = array.array("I")
+    directory = os.path.dirname(filename)
+    previous = None
+    with tempfile.TemporaryFile(dir=directory) as spool:
+        for entry in entries:
+            if previous is not None and entry <= previous:
+                if entry == previous:
+                    continue
+                raise ValueError("the paths are not sorted")
+            previous = entry
+            path, package = entry
+            number = ids.get(package)
+            if number is None:
+                number = ids[package] = len(packages)
+                packages.append(package)
+            spool.write(path)
+            offsets.append(offsets[-1] + len(path))
+            package_ids.append(number)
+        # Counting sort the path numbers by package into the postings.
+        starts = array.array("I", [0]) * (len(packages) + 1)
+        for number in package_ids:
+            starts[number + 1] += 1
+        for number in range(len(packages)):
+            starts[number + 1] += starts[number]
+        postings = array.array("I", [0]) * len(package_ids)
+        fill = starts[:-1]
+        for path_number, number in enumerate(package_ids):
+            postings[fill[number]] = path_number
+            fill[number] += 1
+        package_block = "\n".join(packages).encode()
+        meta_block = json.dumps(meta).encode()
+        head = HEADER.pack(MAGIC, len(meta_block), len(package_block),
+                           len(package_ids))
+        head += meta_block + package_block
+        # Align the arrays for reading them in place.
+        head += b"\0" * (-len(head) % offsets.itemsize)
+        temporary_file = tempfile.mkstemp(dir=directory)[1]
+        with open(temporary_file, "wb") as f:
+            f.write(head)
+            f.write(offsets.tobytes())
+            f.write(package_ids.tobytes())
+            f.write(starts.tobytes())
+            f.write(postings.tobytes())
+            spool.seek(0)
+            shutil.copyfileobj(spool, f)
+    os.replace(temporary_file, filename)
+
+
+class PathIndex:
+    """Read access to a table written by write()"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_length, packages_length, count = \
+            HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError("{} is not a path index".format(filename))
+        start = HEADER.size
+        self.meta = json.loads(self.mm[start:start + meta_length].decode())
+        start += meta_length
+        packages = self.mm[start:start + packages_length].decode()
+        self.packages = packages.split("\n") if packages else []
+        start += packages_length
+        itemsize = array.array("I").itemsize
+        start += -start % itemsize
+        view = memoryview(self.mm)
+        self.offsets = view[start:start + (count + 1) * itemsize].cast("I")
+        start += (count + 1) * itemsize
+        self.ids = view[start:start + count * itemsize].cast("I")
+        start += count * itemsize
+        length = (len(self.packages) + 1) * itemsize
+        self.starts = view[start:start + length].cast("I")
+        start += length
+        self.postings = view[start:start + count * itemsize].cast("I")
+        self.base = start + count * itemsize
+        self.count = count
+
+    def close(self):
+        self.offsets.release()
+        self.ids.release()
+        self.starts.release()
+        self.postings.release()
+        self.mm.close()
+
+    def path(self, number):
+        return self.mm[self.base + self.offsets[number]:
+                       self.base + self.offsets[number + 1]]
+
+    def entry(self, number):
+        return self.path(number), self.packages[self.ids[number]]
+
+    def entries(self):
+        """Yield every (path bytes, package name) in path order"""
+        for number in range(self.count):
+            yield self.entry(number)
+
+    def first(self, key):
+        """Return the number of the first path not sorting before KEY"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.path(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def exact(self, key):
+        number = self.first(key)
+        while number < self.count and self.path(number) == key:
+            yield self.entry(number)
+            number += 1
+
+    def prefix(self, key):
+        number = self.first(key)
+        while number < self.count and self.path(number).startswith(key):
+            yield self.entry(number)
+            number += 1
+
+    def substring(self, text, basename=False):
+        """Yield the entries whose path, or only its last component when
+        BASENAME is true, contains TEXT; the paths block is searched by
+        mmap.find() rather than path by path. A suffix table would avoid
+        the scan, but at several times the size of the paths block."""
+        end = self.base + self.offsets[self.count]
+        position = self.mm.find(text, self.base, end)
+        while position != -1:
+            # Bisect over the path offsets for the path holding the match;
+            # as paths are not separated, a match may run into the next.
+            number = bisect.bisect_right(self.offsets, position - self.base,
+                                         0, self.count) - 1
+            path = self.path(number)
+            if basename:
+                path = path[path.rfind(b"/") + 1:]
+            if text in path:
+                yield self.entry(number)
+            position = self.mm.find(text, self.base +
+                                    self.offsets[number + 1], end)
+
+    def package_entries(self, package):
+        """Yield the entries of one package, in path order"""
+        try:
+            wanted = self.packages.index(package)
+        except ValueError:
+            return
+        for posting in range(self.starts[wanted], self.starts[wanted + 1]):
+            yield self.entry(self.postings[posting])
+
+    def glob(self, pattern):
+        for path, package in self.entries():
+            if fnmatch.fnmatchcase(path.decode(errors="replace"), pattern):
+                yield path, package
+
+    def search(self, pattern):
+        """Yield the entries matching PATTERN the way 'dpkg --search'
+        does: an absolute path exactly (or everything under it when it
+        ends with / or *), a glob pattern, or else a substring of the
+        file name, or of the path when PATTERN holds a /"""
+        if pattern.startswith("/") and pattern.endswith("*") and \
+           not any(c in pattern[:-1] for c in "*?["):
+            return self.prefix(pattern[:-1].encode())
+        if any(c in pattern for c in "*?["):
+            return self.glob(pattern)
+        if pattern.startswith("/"):
+            if pattern.endswith("/") and len(pattern) > 1:
+                return self.prefix(pattern.encode())
+            return self.exact(pattern.encode())
+        return self.substring(pattern.encode(), "/" not in pattern)
+
+
+def grouped(entries):
+    """Merge (path, package) entries of the same path into (path, packages)"""
+    result = list()
+    for path, package in entries:
+        if result and result[-1][0] == path:
+            result[-1][1].append(package)
+        else:
+            result.append((path, [package]))
+    return [(path.decode(errors="replace"), packages)
+            for path, packages in result]
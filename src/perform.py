@@ -2,6 +2,7 @@
 
 import os
 import subprocess
+import tempfile
 
 
 SIMULATE = False
@@ -25,8 +26,15 @@ else:
     setroot = "/bin/su"
 
 
+def show_input(input):
+    """Print what a simulated or taught command is fed, a line at a time"""
+    if input:
+        for line in input.replace("\0", "\n").splitlines():
+            print("  " + line)
+
+
 def execute(command, root=False, pipe=False, langC=False,
-            getoutput=False, log=False):
+            getoutput=False, log=False, input=None):
     """Ask the operating system to perform a command.
 
     Arguments:
@@ -35,10 +43,30 @@ def execute(command, root=False, pipe=False, langC=False,
     ROOT        If True, root access is required to execute command
     PIPE        If True then return a file-like object.
     LANGC       If LC_TYPE=C is needed (as in join in status command)
+    INPUT       A string to feed to the command on its standard input,
+                not to be combined with PIPE
 
     Returns either the status of the command or a file-like object
     if PIPE is True."""
 
+    if input is None:
+        return run(command, root, pipe, langC, getoutput, log)
+    # su reads the password from standard input, so rather than through
+    # a pipe the input is handed over in a file.
+    fd, spool = tempfile.mkstemp(prefix="wajig_")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(input)
+        return run(command + " < " + spool, root, pipe, langC, getoutput,
+                   log, input)
+    finally:
+        os.remove(spool)
+
+
+def run(command, root, pipe, langC, getoutput, log, input=None):
+    """Perform a command as execute() describes, showing INPUT as well
+    when simulating or teaching"""
+
     if root:
         if setroot == "/usr/bin/sudo":
             #
@@ -81,9 +109,11 @@ def execute(command, root=False, pipe=False, langC=False,
         command = "LC_ALL=C; export LC_ALL; " + command
     elif SIMULATE:
         print(highlight(" ".join(command.split())))
+        show_input(input)
         return
     if TEACH:
         print(highlight(" ".join(command.split())))
+        show_input(input)
     if pipe:
         return os.popen(command)
     if getoutput:
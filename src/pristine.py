@@ -0,0 +1,93 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""The packaged versions of configuration files.
+
+A conffile changed locally is compared with the copy in the .deb of
+the installed version, found in APT's download cache (where DOWNLOAD
+also puts debs) or among the backups made before upgrades. Only the
+wanted members are read out of the .deb, in a single pass through its
+data.tar, stopping as soon as all of them have been seen."""
+
+import concurrent.futures
+import difflib
+import os
+
+import archives
+import backup
+import checksums
+import debreader
+import util
+
+WORKERS = 4
+
+
+def find_deb(entry, backed_up):
+    """Return the .deb of the installed version of a package, or None"""
+    name, version = entry["Package"], entry["Version"]
+    arch = entry["Architecture"]
+    deb = archives.find(name, version, arch)
+    if deb is not None:
+        return deb.path
+    return backed_up.get(backup.deb_filename(name, version, arch))
+
+
+def diverted_from():
+    """Return a dict of where each diverted file lives now to the path
+    it is packaged under and the diverting package, paths relative to /"""
+    return dict((target.lstrip("/"), (source.lstrip("/"), package))
+                for source, (target, package)
+                in checksums.diversions().items())
+
+
+def extract(deb, paths):
+    """Return a dict of each of PATHS (relative to /) to its contents in
+    the data.tar of DEB"""
+    wanted = set(paths)
+    found = dict()
+    with debreader.open_tar(deb, "data.tar") as tar:
+        for member in tar:
+            name = debreader.member_path(member)
+            if name in wanted and member.isfile():
+                found[name] = tar.extractfile(member).read()
+                if len(found) == len(wanted):
+                    break
+    return found
+
+
+def originals(changed):
+    """Yield (package, deb, dict of path to packaged contents) for each
+    package of the CHANGED dict of package to paths, reading the debs in
+    parallel; DEB is None when no .deb of the installed version is found"""
+    installed = util.installed_packages()
+    backed_up = backup.backed_up()
+    debs = dict((package, find_deb(installed[package], backed_up))
+                for package in changed)
+
+    def read(package):
+        if debs[package] is None:
+            return dict()
+        return extract(debs[package], changed[package])
+
+    with concurrent.futures.ThreadPoolExecutor(WORKERS) as pool:
+        futures = [(package, pool.submit(read, package))
+                   for package in sorted(changed)]
+        for package, future in futures:
+            try:
+                contents = future.result()
+            except debreader.READ_ERRORS:
+                contents = dict()
+            yield package, debs[package], contents
+
+
+def unified_diff(path, original, label):
+    """Return the lines of a unified diff from ORIGINAL to the file at
+    PATH (relative to /), which for a diverted file is where it lives
+    now rather than its packaged path"""
+    with open(os.path.join(util.root_dir, path), "rb") as f:
+        current = f.read()
+    if b"\0" in original or b"\0" in current:
+        return ["Binary files {} and /{} differ\n".format(label, path)]
+    return difflib.unified_diff(
+        original.decode(errors="replace").splitlines(True),
+        current.decode(errors="replace").splitlines(True),
+        label, "/" + path)
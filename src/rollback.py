@@ -0,0 +1,154 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Undo a transaction recorded in the wajig Log.
+
+Every command run with logging appends one line per changed package,
+all sharing the timestamp of the run:
+
+    2010-09-21T09:21:00 upgrade bash 4.1-3 4.1-2
+
+that is the action, the package and its new version, followed for
+upgrades and downgrades by the version it replaced (older logs lack
+this, and the previous version is then looked up in earlier entries).
+The reverse of a transaction is installed from debs kept by backups or
+in APT's download cache, or else from any source still offering the old
+versions, such as a pinned snapshot archive."""
+
+import collections
+
+import apt_pkg
+
+import archives
+import backup
+import util
+
+Entry = collections.namedtuple(
+    "Entry", "timestamp action package version previous"
+)
+
+REVERSE = {
+    "install": "remove",
+    "remove": "install",
+    "upgrade": "downgrade",
+    "downgrade": "upgrade",
+}
+
+
+def read_log():
+    """Return the entries of the Log, oldest first"""
+    entries = list()
+    try:
+        with open(util.log_file) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 4 or fields[1] not in REVERSE:
+                    continue
+                previous = fields[4] if len(fields) > 4 else None
+                entries.append(Entry(fields[0], fields[1], fields[2],
+                                     fields[3], previous))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def transaction(entries, timestamp=None):
+    """Split the entries into those before the transaction at TIMESTAMP,
+    by default the last one, and those of the transaction itself"""
+    if timestamp is None and entries:
+        timestamp = entries[-1].timestamp
+    selected = [entry for entry in entries if entry.timestamp == timestamp]
+    if not selected:
+        return entries, []
+    first = entries.index(selected[0])
+    return entries[:first], selected
+
+
+def previous_version(entry, earlier):
+    """Return the version a package had before the logged ENTRY"""
+    if entry.action == "remove":
+        return entry.version
+    if entry.previous is not None:
+        return entry.previous
+    for before in reversed(earlier):
+        if before.package == entry.package:
+            if before.action == "remove":
+                return None
+            return before.version
+    return None
+
+
+def local_debs():
+    """Return a dict of (package, version) to a deb file kept locally"""
+    debs = dict()
+    for filename, path in backup.backed_up().items():
+        parsed = archives.parse_filename(filename)
+        if parsed is not None:
+            debs.setdefault(parsed[:2], path)
+    for name, cached in archives.index().items():
+        for deb in cached:
+            debs.setdefault((name, deb.version), deb.path)
+    return debs
+
+
+def plan(timestamp=None):
+    """Work out how to undo a logged transaction
+
+    Returns the timestamp of the transaction, a list of (action,
+    package, installed version, target version, source) changes, where
+    SOURCE is a local deb file, 'apt' or None for removals, and a list
+    of the packages whose old version could not be found."""
+    earlier, entries = transaction(read_log(), timestamp)
+    if not entries:
+        return timestamp, [], []
+    installed = dict((entry["Package"], entry["Version"])
+                     for entry in util.installed_packages().values())
+    debs = local_debs()
+    cache = util.get_cache()
+    changes = list()
+    missing = list()
+    for entry in entries:
+        action = REVERSE[entry.action]
+        current = installed.get(entry.package)
+        if action == "remove":
+            if current is not None:
+                changes.append((action, entry.package, current, None, None))
+            continue
+        target = previous_version(entry, earlier)
+        if target is None:
+            missing.append(entry.package)
+            continue
+        if current == target:
+            continue
+        if current is not None:
+            compare = apt_pkg.version_compare(target, current)
+            action = "downgrade" if compare < 0 else "upgrade"
+        source = debs.get((entry.package, target))
+        if source is None:
+            try:
+                versions = cache[entry.package].versions
+            except KeyError:
+                versions = []
+            if any(version.version == target and version.downloadable
+                   for version in versions):
+                source = "apt"
+        if source is None:
+            missing.append("{}={}".format(entry.package, target))
+            continue
+        changes.append((action, entry.package, current, target, source))
+    return entries[0].timestamp, changes, missing
+
+
+def rollback_command(changes, yes="", noauth=""):
+    """Build the single apt-get transaction carrying out the changes"""
+    targets = list()
+    for action, package, current, target, source in changes:
+        if action == "remove":
+            targets.append(package + "-")
+        elif source == "apt":
+            targets.append("{}={}".format(package, target))
+        else:
+            targets.append(source)
+    downgrades = any(change[0] == "downgrade" for change in changes)
+    return "/usr/bin/apt-get {} {} {} install {}".format(
+        yes, noauth, "--allow-downgrades" if downgrades else "",
+        " ".join(targets))
@@ -0,0 +1,130 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Take snapshots of the installed packages and restore them.
+
+A snapshot has one name:arch=version line per installed package, sorted
+so that snapshots of different hosts or dates compare line by line."""
+
+import os
+import tempfile
+
+import apt_pkg
+
+import util
+
+
+def generate():
+    """Return the snapshot lines of the installed packages"""
+    lines = list()
+    for entry in util.installed_packages().values():
+        lines.append("{}:{}={}".format(
+            entry["Package"], entry["Architecture"], entry["Version"]))
+    lines.sort()
+    return lines
+
+
+def save(lines):
+    """Keep a copy of the snapshot for comparing hosts with fleetdiff"""
+    temporary_file = tempfile.mkstemp()[1]
+    with open(temporary_file, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+    os.rename(temporary_file, util.snapshot_file)
+
+
+def split_arch(package, native):
+    name, sep, arch = package.partition(":")
+    # APT files Architecture: all packages under the native architecture.
+    if not sep or arch == "all":
+        arch = native
+    return name, arch
+
+
+def read(path):
+    """Yield package and version from each line of a snapshot
+
+    Older snapshots have plain name=version lines. So that they compare
+    equal to newer ones, the native and 'all' architectures are dropped
+    from the names and only foreign ones are kept, as in name:i386."""
+    native = apt_pkg.get_architectures()[0]
+    with open(path) as f:
+        for line in f:
+            package, sep, version = line.strip().partition("=")
+            if not sep:
+                continue
+            name, arch = split_arch(package, native)
+            if arch != native:
+                name = "{}:{}".format(name, arch)
+            yield name, version
+
+
+def plan_restore(path):
+    """Work out the changes bringing the system to the snapshot in PATH
+
+    The versions of the snapshot are made candidates in an apt_pkg
+    DepCache and everything installed but absent from the snapshot is
+    marked for removal; only packages the DepCache then reports as
+    changing end up in the plan. Returns a dict of action to a list of
+    (package, old version, new version), plus the snapshot entries not
+    available from any source."""
+    native = apt_pkg.get_architectures()[0]
+    cache = apt_pkg.Cache(None)
+    depcache = apt_pkg.DepCache(cache)
+    wanted = set()
+    unavailable = list()
+    for package, version in read(path):
+        name, arch = split_arch(package, native)
+        try:
+            pkg = cache[name, arch]
+        except KeyError:
+            unavailable.append("{}={}".format(package, version))
+            continue
+        wanted.add(pkg.id)
+        if pkg.current_ver and pkg.current_ver.ver_str == version:
+            continue
+        for ver in pkg.version_list:
+            if ver.ver_str == version:
+                depcache.set_candidate_ver(pkg, ver)
+                depcache.mark_install(pkg, False)
+                break
+        else:
+            unavailable.append("{}={}".format(package, version))
+    for pkg in cache.packages:
+        if pkg.current_ver and pkg.id not in wanted:
+            depcache.mark_delete(pkg)
+
+    plan = {"install": [], "upgrade": [], "downgrade": [], "remove": []}
+    for pkg in cache.packages:
+        if depcache.marked_delete(pkg):
+            action = "remove"
+        elif depcache.marked_install(pkg):
+            action = "install"
+        elif depcache.marked_upgrade(pkg):
+            action = "upgrade"
+        elif depcache.marked_downgrade(pkg):
+            action = "downgrade"
+        else:
+            continue
+        old = pkg.current_ver.ver_str if pkg.current_ver else None
+        candidate = depcache.get_candidate_ver(pkg)
+        new = candidate.ver_str if candidate and action != "remove" else None
+        name = "{}:{}".format(pkg.name, pkg.architecture)
+        plan[action].append((name, old, new))
+    if depcache.broken_count:
+        print("Warning: the snapshot leaves {} packages with unmet "
+              "dependencies.".format(depcache.broken_count))
+    return plan, unavailable
+
+
+def restore_command(plan, yes="", noauth=""):
+    """Build the single apt-get transaction carrying out the plan"""
+    targets = list()
+    for action in ("install", "upgrade", "downgrade"):
+        for name, old, new in plan[action]:
+            targets.append("{}={}".format(name, new))
+    for name, old, new in plan["remove"]:
+        targets.append(name + "-")
+    command = "/usr/bin/apt-get {} {} {} install {}".format(
+        yes, noauth, "--allow-downgrades" if plan["downgrade"] else "",
+        " ".join(sorted(targets)))
+    return command
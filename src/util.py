@@ -4,15 +4,18 @@
 
 import os
 import sys
+import collections
+import gzip
+import shutil
 import tempfile
 import re
 import socket
 from datetime import datetime
-import time
 
 import apt
 import apt_pkg
 
+import debreader
 import perform
 
 
@@ -71,6 +74,28 @@ if not os.path.exists(new_file):
 available_file = init_dir + "/Available"
 previous_file = init_dir + "/Available.prv"
 
+# The latest snapshot of each host, compared across hosts by fleetdiff.
+snapshot_file = init_dir + "/Snapshot"
+
+# The index of installed files to packages used by whichpackage, and
+# that of the files of all packages from APT's Contents files.
+file_index = init_dir + "/FileIndex"
+contents_index = init_dir + "/ContentsIndex"
+
+# The dependency graph of installed packages, see depgraph.
+dep_graph = init_dir + "/DepGraph"
+
+# The md5sums of files already verified, see checksums.
+md5_cache = init_dir + "/Md5Cache"
+
+# The filesystem tree being managed, changed from / by set_root().
+# Options for dpkg and the APT tools are extended to match.
+root_dir = "/"
+status_file = "/var/lib/dpkg/status"
+info_dir = "/var/lib/dpkg/info"
+dpkg_options = ""
+apt_options = ""
+
 # Set the temporary directory to the init_dir.
 # Large files are not generally written there so should be okay.
 tempfile.tempdir = init_dir
@@ -103,7 +128,7 @@ def update_available(noreport=False):
     # output of "toupgrade", though not necessarily with the list shown
     # by "upgrade" (really "apt-get --show-upgraded upgrade"), which might
     # show amd64 and i386 versions.
-    command = ("apt-cache dumpavail "
+    command = ("apt-cache " + apt_options + " dumpavail "
                "| egrep '^(Package|Version):' "
                "| tr '\n' ' '"
                "| perl -p -e 's|Package: |\n|g; s|Version: ||g'"
@@ -146,7 +171,7 @@ def update_available(noreport=False):
 def gen_installed_command_str():
     """Generate command to list installed packages and their status."""
     # Use sort --unique. See comment in update_available().
-    command = ("cat /var/lib/dpkg/status | "
+    command = ("cat " + status_file + " | "
                "egrep '^(Package|Status|Version):' | "
                "awk '/^Package: / {pkg=$2} "
                "     /^Status: / {s1=$2;s2=$3;s3=$4}"
@@ -155,6 +180,137 @@ def gen_installed_command_str():
     return command
 
 
+# Only the fields wajig makes use of are retained from each stanza.
+STATUS_FIELDS = (
+    "Package", "Architecture", "Version", "Status", "Installed-Size",
+    "Section", "Priority", "Essential", "Multi-Arch", "Source", "Provides",
+    "Pre-Depends", "Depends", "Recommends", "Suggests", "Conflicts",
+    "Breaks", "Conffiles",
+)
+
+_status_cache = dict()
+_apt_cache = dict()
+
+
+def file_fingerprint(path):
+    """Identify the current contents of a file without reading it."""
+    try:
+        info = os.stat(path)
+    except FileNotFoundError:
+        return (path, None)
+    return (path, info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def get_cache():
+    """Return the apt.Cache shared by all commands of this run.
+
+    It is rebuilt only once the dpkg status or APT's package cache
+    changes, that is after a transaction or an update."""
+    key = (file_fingerprint(status_file),
+           file_fingerprint(apt_pkg.config.find_file("Dir::Cache::pkgcache")))
+    if key not in _apt_cache:
+        _apt_cache.clear()
+        _apt_cache[key] = apt.Cache()
+    return _apt_cache[key]
+
+
+def read_status():
+    """Parse the dpkg status file into a dict of package name to fields.
+
+    Packages of a foreign architecture are keyed as name:arch, just as
+    'dpkg --get-selections' shows them. The result is kept for as long
+    as the status file is unchanged, so one run pays for a single parse."""
+    key = file_fingerprint(status_file)
+    if key in _status_cache:
+        return _status_cache[key]
+    native = apt_pkg.get_architectures()[0]
+    packages = dict()
+    with open(status_file) as f:
+        for section in apt_pkg.TagFile(f):
+            entry = {field: section[field] for field in STATUS_FIELDS
+                     if field in section}
+            name = entry["Package"]
+            if entry.get("Architecture", native) not in (native, "all"):
+                name = "{}:{}".format(name, entry["Architecture"])
+            packages[name] = entry
+    _status_cache.clear()
+    _status_cache[key] = packages
+    return packages
+
+
+def installed_packages():
+    """Return the status entries of packages that are fully installed."""
+    return {name: entry for name, entry in read_status().items()
+            if entry.get("Status", "").endswith("ok installed")}
+
+
+def held_packages():
+    """Return the sorted names of packages selected to be on hold."""
+    return sorted(name for name, entry in read_status().items()
+                  if entry.get("Status", "").startswith("hold "))
+
+
+def auto_installed():
+    """Return the names of packages APT marked as automatically installed.
+
+    They are read from APT's extended_states file and named the way
+    read_status() names them."""
+    native = apt_pkg.get_architectures()[0]
+    names = set()
+    path = apt_pkg.config.find_file("Dir::State::extended_states")
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return names
+    with f:
+        for section in apt_pkg.TagFile(f):
+            if section.get("Auto-Installed") != "1":
+                continue
+            name = section["Package"]
+            if section.get("Architecture", native) not in (native, "all"):
+                name = "{}:{}".format(name, section["Architecture"])
+            names.add(name)
+    return names
+
+
+def resolve_packages(patterns, names):
+    """Expand glob and regular expression patterns against package names.
+
+    A pattern naming a package exactly is taken as is; one containing
+    any of '*?[' is a shell glob; anything else is tried as a regular
+    expression matching the whole name. Patterns matching nothing are
+    passed through unchanged so the underlying tool can report them."""
+    import fnmatch
+    names = sorted(names)
+    known = set(names)
+    packages = list()
+    for pattern in patterns:
+        if pattern in known:
+            matches = [pattern]
+        elif any(char in pattern for char in "*?["):
+            matches = fnmatch.filter(names, pattern)
+        else:
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                matches = []
+            else:
+                matches = [name for name in names if regex.fullmatch(name)]
+        packages.extend(matches or [pattern])
+    # Drop duplicates while keeping the order given.
+    return list(collections.OrderedDict.fromkeys(packages))
+
+
+def set_selections(packages, selection):
+    """Set the dpkg selection of all packages in one transaction."""
+    if not packages:
+        return 0
+    lines = "".join("{} {}\n".format(package, selection)
+                    for package in packages)
+    command = "/usr/bin/dpkg {} --set-selections".format(dpkg_options)
+    return perform.execute(command, root=True, input=lines)
+
+
 def count_upgrades():
     """Return as a string the number of new upgrades since last update."""
     ifile = tempfile.mkstemp()[1]
@@ -187,22 +343,104 @@ def ensure_initialised():
         reset_files()
 
 
-def backup_before_upgrade(packages):
-    """Backup packages before a (dist)upgrade.
+class RootError(Exception):
+    """Raised when an alternate root is not a tree dpkg manages."""
+
 
-     This optional functionality helps recovery in case of trouble caused
-     by the newly-installed packages. The packages are by default stored
-     in a directory named like  ~/.wajig/hostname/backups/2010-09-21_09h21."""
+def set_root(root):
+    """Manage the filesystem tree under ROOT (a chroot or image) instead of /.
+
+    The dpkg status, APT's configuration and the Available files all
+    follow; the latter are kept per root under init_dir/roots."""
+    global root_dir, status_file, info_dir, dpkg_options, apt_options
+    global available_file, previous_file, new_file, snapshot_file
+    global file_index, contents_index, dep_graph, md5_cache
+    root = os.path.abspath(root)
+    if root == "/":
+        return
+    status = os.path.join(root, "var/lib/dpkg/status")
+    if not os.path.exists(status):
+        raise RootError("No dpkg status file found under '{}'".format(root))
+    root_dir = root
+    status_file = status
+    info_dir = os.path.join(root, "var/lib/dpkg/info")
+    apt_pkg.config.set("Dir", root + "/")
+    apt_pkg.config.set("Dir::State::status", status_file)
+    dpkg_options = "--root=" + root
+    apt_options = "-o Dir={}/ -o Dir::State::status={}"
+    apt_options = apt_options.format(root, status_file)
+    state_dir = root.strip("/").replace("/", "_")
+    state_dir = os.path.join(init_dir, "roots", state_dir)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    available_file = os.path.join(state_dir, "Available")
+    previous_file = os.path.join(state_dir, "Available.prv")
+    new_file = os.path.join(state_dir, "New")
+    snapshot_file = os.path.join(state_dir, "Snapshot")
+    file_index = os.path.join(state_dir, "FileIndex")
+    contents_index = os.path.join(state_dir, "ContentsIndex")
+    dep_graph = os.path.join(state_dir, "DepGraph")
+    md5_cache = os.path.join(state_dir, "Md5Cache")
+    if not os.path.exists(new_file):
+        with open(new_file, 'w'):
+            pass
+    ensure_initialised()
+
+
+def run_in_root(args, root):
+    """Run a command against ROOT, returning everything it printed.
+
+    Output is captured at the file descriptor level so that programs
+    run through perform.execute() are captured as well. A ROOT that is
+    not a dpkg tree is reported in the output like any other failure."""
+    with tempfile.TemporaryFile() as output:
+        sys.stdout.flush()
+        saved = os.dup(1)
+        os.dup2(output.fileno(), 1)
+        try:
+            set_root(root)
+            args.func(args)
+        except (Exception, SystemExit) as error:
+            print("wajig: {}".format(error))
+        finally:
+            sys.stdout.flush()
+            os.dup2(saved, 1)
+            os.close(saved)
+        output.seek(0)
+        return output.read().decode(errors="replace")
+
+
+def fan_out(roots, args):
+    """Run a read-only command against many roots using a process pool"""
+    import concurrent.futures
+    import functools
+    run = functools.partial(run_in_root, args)
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        for root, output in zip(roots, pool.map(run, roots)):
+            print("{0:=^72}".format(" {0} ".format(root)))
+            print(output, end="")
+            sys.stdout.flush()
+
+
+def human_size(size):
+    """Format a number of bytes the way 'ls -sh' does."""
+    for unit in "BKMGT":
+        if size < 1024 or unit == "T":
+            break
+        size /= 1024
+    if unit == "B":
+        return "{}{}".format(int(size), unit)
+    return "{:.1f}{}".format(size, unit)
 
-    date = time.strftime("%Y-%m-%d_%Hh%M", time.localtime())
-    target = os.path.join(init_dir, "backups", date)
-    if not os.path.exists(target):
-        os.makedirs(target)
-    os.chdir(target)
-    print("The packages will saved in", target)
-    for package in packages:
-        command = "fakeroot -u dpkg-repack " + package
-        perform.execute(command)
+
+def parse_size(text):
+    """Turn a size such as 500M or 2G into a number of bytes."""
+    units = {"": 1, "B": 1, "K": 1024, "M": 1024**2, "G": 1024**3,
+             "T": 1024**4}
+    match = re.match(r"^\s*([\d.]+)\s*([BKMGT]?)I?B?\s*$", text.upper())
+    if not match:
+        raise ValueError("invalid size: '{}'".format(text))
+    return int(float(match.group(1)) * units[match.group(2)])
 
 
 def requires_package(package, path=None):
@@ -227,25 +465,42 @@ def package_exists(cache, package, ignore_virtual_packages=False):
 
 def upgradable(distupgrade=False, get_names_only=True):
     "Checks if the system is upgradable."
-    cache = apt.Cache()
+    cache = get_cache()
     cache.upgrade(distupgrade)
     if get_names_only:
         packages = [package.name for package in cache.get_changes()]
     else:
         packages = [package for package in cache.get_changes()]
+    # The cache is shared, so leave no marks behind.
+    cache.clear()
     return packages
 
 
-def local_changelog(package, tmp):
-    """Retrieve Debian changelog from local installation."""
-    changelog = "/usr/share/doc/" + package + "/changelog.Debian.gz"
-    changelog_native = "/usr/share/doc/" + package + "/changelog.gz"
-    if os.path.exists(changelog):
-        return "zcat {0} >> {1}".format(changelog, tmp)
-    elif os.path.exists(changelog_native):
-        return "zcat {0} >> {1}".format(changelog_native, tmp)
-    else:
-        print("Package", package, "is likely broken (changelog not found)!")
+def local_changelog(package):
+    """Return the path of the Debian changelog of an installed package."""
+    for filename in ("changelog.Debian.gz", "changelog.gz"):
+        path = os.path.join("/usr/share/doc", package, filename)
+        if os.path.exists(path):
+            return path
+    print("Package", package, "is likely broken (changelog not found)!")
+
+
+def stream_doc(path):
+    """Copy a plain or gzipped file to standard output, a block at a time."""
+    opener = gzip.open if path.endswith(".gz") else open
+    sys.stdout.flush()
+    with opener(path, "rb") as f:
+        shutil.copyfileobj(f, sys.stdout.buffer, 1 << 16)
+    sys.stdout.buffer.flush()
+
+
+def stdout_closed():
+    """Quietly give up writing once the reader (head, less) has gone.
+
+    Standard output is pointed at /dev/null so that the flush Python does
+    on exit does not fail again."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
 
 
 def extract_dependencies(package, dependency_type="Depends"):
@@ -266,9 +521,14 @@ def do_describe(packages, verbose=False, die=True):
                      if not package.endswith(".deb")]
     if package_files:
         for package_file in package_files:
-            perform.execute("dpkg-deb --info " + package_file)
+            try:
+                control = debreader.read_control(package_file)
+            except debreader.READ_ERRORS as e:
+                print("{}: {}".format(package_file, e))
+            else:
+                for line in debreader.info_lines(control):
+                    print(line)
             print("="*72)
-            sys.stdout.flush()
 
     if package_names:
         packages = package_names
@@ -279,7 +539,7 @@ def do_describe(packages, verbose=False, die=True):
         print("No packages found from those known to be available/installed.")
     else:
         packageversions = list()
-        cache = apt.cache.Cache()
+        cache = get_cache()
         for package in packages:
             try:
                 package = cache[package]
@@ -332,37 +592,51 @@ def show_package_versions():
     return packages
 
 
-def display_sys_docs(package, filenames):
+def display_sys_docs(packages, filenames):
     """This services README and NEWS commands"""
-    docpath = os.path.join("/usr/share/doc", package)
-    if not os.path.exists(docpath):
-        if package_exists(apt.Cache(), package):
-            print("'{}' is not installed".format(package))
-        return
-    found = False
-    for filename in filenames:
-        path = os.path.join(docpath, filename)
-        cat = "cat"
-        if not os.path.exists(path):
-            path += ".gz"
-            cat = "zcat"
-        if os.path.exists(path):
-            found = True
-            print("{0:=^72}".format(" {0} ".format(filename)))
-            sys.stdout.flush()
-            perform.execute(cat + " " + path)
-    if not found:
-        print("File not found")
+    cache = None
+    missing = False
+    try:
+        for package in packages:
+            docpath = os.path.join("/usr/share/doc", package)
+            if not os.path.exists(docpath):
+                # The cache is only needed to tell these two cases apart.
+                if cache is None:
+                    cache = get_cache()
+                if package in cache or cache.is_virtual_package(package):
+                    print("'{}' is not installed".format(package))
+                else:
+                    print("'{}': package not found".format(package))
+                    missing = True
+                continue
+            found = False
+            for filename in filenames:
+                path = os.path.join(docpath, filename)
+                if not os.path.exists(path):
+                    path += ".gz"
+                if os.path.exists(path):
+                    found = True
+                    title = filename
+                    if len(packages) > 1:
+                        title = "{} {}".format(package, filename)
+                    print("{0:=^72}".format(" {0} ".format(title)))
+                    stream_doc(path)
+            if not found:
+                print("File not found" if len(packages) == 1 else
+                      "{}: file not found".format(package))
+    except BrokenPipeError:
+        stdout_closed()
+    if missing:
+        sys.exit(1)
 
 
-def do_status(packages, snapshot=False):
+def do_status(packages):
     """List status of the packages identified"""
 
-    if not snapshot:
-        print("%-23s %-15s %-15s %-15s %s" % \
-              ("Package", "Installed", "Previous", "Now", "State"))
-        print("="*23 + "-" + "="*15 + "-" + "="*15 + "-" + "="*15 + "-" + "="*5)
-        sys.stdout.flush()
+    print("%-23s %-15s %-15s %-15s %s" % \
+          ("Package", "Installed", "Previous", "Now", "State"))
+    print("="*23 + "-" + "="*15 + "-" + "="*15 + "-" + "="*15 + "-" + "="*5)
+    sys.stdout.flush()
 
     # Generate a temporary file of installed packages.
     ifile = tempfile.mkstemp()[1]
@@ -370,7 +644,8 @@ def do_status(packages, snapshot=False):
     perform.execute(gen_installed_command_str() + " > " + ifile,
                     langC=True)
     # Build the command to list the status of installed packages.
-    command = "dpkg --get-selections | sort | join - " + ifile + " | " +\
+    command = "dpkg " + dpkg_options + " --get-selections | sort | " +\
+              "join - " + ifile + " | " +\
               "join -a 1 - " + previous_file + " | " +\
               "awk 'NF==3 {print $0, \"N/A\"; next}{print}' | " +\
               "join -a 1 - " + available_file + " | " +\
@@ -385,12 +660,7 @@ def do_status(packages, snapshot=False):
     command = command +\
               "awk '{printf(\"%-20s\\t%-15s\\t%-15s\\t%-15s\\t%-2s\\n\", " +\
               "$1, $3, $4, $5, $2)}'"
-    if snapshot:
-        fobj = perform.execute(command, pipe=True)
-        for l in fobj:
-            print("=".join(l.split()[0:2]))
-    else:
-        perform.execute(command, langC=True)
+    perform.execute(command, langC=True)
 
     # Check whether the package is not in the installed list, and if not
     # list its status appropriately.
@@ -466,12 +736,14 @@ def consolidate_package_names(args):
 
 
 def sizes(packages=None, size=0):
-    status = apt_pkg.TagFile(open("/var/lib/dpkg/status", "r"))
+    status = apt_pkg.TagFile(open(status_file, "r"))
     size_list = dict()
     status_list = dict()
 
     for section in status:
         package_name = section.get("Package")
+        if packages and package_name not in packages:
+            continue
         package_size = section.get("Installed-Size")
         package_status = re.split(" ", section.get("Status"))[2]
         if package_size and float(package_size) > size:
@@ -492,8 +764,10 @@ def sizes(packages=None, size=0):
                 status_list[package],
             )
             print(message)
+    elif size:
+        print("No packages of >{}MB size found".format(size // 1000))
     else:
-        print("No packages of >10MB size found")
+        print("No packages found")
 
 
 log_file = os.path.join(init_dir, 'Log')
@@ -505,31 +779,29 @@ def start_log(old_log):
 
 
 def finish_log(old_log):
+    """Append a line to the log for each package the command changed.
+
+    Upgrades and downgrades also record the version replaced, which is
+    what ROLLBACK restores."""
     ts = datetime.strftime(datetime.now(), '%Y-%m-%dT%H:%M:%S')
     # Generate new list of installed and compare to old
-    lf = open(log_file, "a")
+    with open(old_log) as f:
+        old = dict(line.split()[:2] for line in f if line.strip())
     new_iter = perform.execute(gen_installed_command_str(),
                                langC=True, pipe=True)
-    old_iter = open(old_log)
-    for o in old_iter:
-        o = o.strip().split(" ")
-        n = new_iter.__next__().strip().split(" ")
-        while o[0] != n[0]:
-            if o[0] < n[0]:
-                lf.write("{0} {1} {2} {3}\n".format(ts, "remove", o[0], o[1]))
-                o = old_iter.__next__().strip().split(" ")
-            elif o[0] > n[0]:
-                lf.write("{0} {1} {2} {3}\n".format(ts, "install", n[0], n[1]))
-                n = new_iter.__next__().strip().split(" ")
-
-        if o[1] != n[1]:
-            old_version = o[1].split(".")  # for a more accurate comparison
-            new_version = n[1].split(".")  # same
-            if old_version > new_version:
-                lf.write(
-                    "{0} {1} {2} {3}\n".format(ts, "downgrade", n[0], n[1])
-                )
+    new = dict(line.split()[:2] for line in new_iter if line.strip())
+    with open(log_file, "a") as lf:
+        for package in sorted(set(old) | set(new)):
+            before, after = old.get(package), new.get(package)
+            if before == after:
+                continue
+            if after is None:
+                fields = (ts, "remove", package, before)
+            elif before is None:
+                fields = (ts, "install", package, after)
+            elif apt_pkg.version_compare(after, before) < 0:
+                fields = (ts, "downgrade", package, after, before)
             else:
-                lf.write("{0} {1} {2} {3}\n".format(ts, "upgrade", n[0], n[1]))
-
+                fields = (ts, "upgrade", package, after, before)
+            lf.write(" ".join(fields) + "\n")
     os.remove(old_log)
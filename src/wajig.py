@@ -21,22 +21,45 @@
 #
 
 import argparse
+import glob
 import sys
 
 import commands
 import perform
+import util
 
 VERSION = "2.20~pre"
 
+# Read-only queries that can be run across many roots at once.
+FAN_OUT_COMMANDS = (
+    commands.status, commands.sizes, commands.snapshot,
+    commands.whichpackage, commands.listinstalled,
+)
 
-def main():
+# Queries that read the alternate tree given with --root. Everything else
+# would run dpkg or apt-get against the host, so it is refused.
+ROOT_COMMANDS = FAN_OUT_COMMANDS + (
+    commands.conffiles, commands.integrity, commands.large,
+    commands.listfiles, commands.listhold, commands.orphans,
+    commands.recommended, commands.statusmatch, commands.verify,
+    commands.why, commands.whynot,
+)
 
-    # without arguments, run a wajig shell (interactive mode)
-    if len(sys.argv) == 1:
-        import subprocess
-        command = "python3 /usr/share/wajig/shell.py"
-        subprocess.call(command.split())
-        return
+
+def count(text):
+    """argparse type for options taking a number that cannot be negative"""
+    try:
+        number = int(text)
+    except ValueError:
+        number = -1
+    if number < 0:
+        message = "'{}' is not a whole number of 0 or more".format(text)
+        raise argparse.ArgumentTypeError(message)
+    return number
+
+
+def build_parser():
+    """Return the argument parser holding all wajig subcommands"""
 
     parser = argparse.ArgumentParser(
         prog="wajig",
@@ -54,6 +77,10 @@ def main():
     parser_backup.add_argument(
         "-b", "--backup", action='store_true', help=message
     )
+    message = "number of dated backups to retain (default: 5)"
+    parser_backup.add_argument(
+        "--keep-backups", type=count, default=5, metavar="N", help=message
+    )
 
     parser_teach = argparse.ArgumentParser(add_help=False)
     group = parser_teach.add_mutually_exclusive_group()
@@ -123,12 +150,38 @@ def main():
         help="filter output, somewhat like grep",
     )
 
+    parser_orphaned = argparse.ArgumentParser(add_help=False)
+    parser_orphaned.add_argument(
+        "--all", action="store_true",
+        help="look for orphans in all sections, not only libraries",
+    )
+    parser_orphaned.add_argument(
+        "--auto", action="store_true",
+        help="only count automatically installed packages as orphans",
+    )
+
     message = "show wajig version"
     parser.add_argument(
         "-V", "--version", action="version", help=message,
         version="%(prog)s " + VERSION
     )
 
+    parser.add_argument(
+        "--root", metavar="DIR",
+        help=(
+            "query the chroot or image under DIR instead of / (read-only "
+            "commands only)"
+        ),
+    )
+    parser.add_argument(
+        "--roots", metavar="DIR", action="append",
+        help=(
+            "run a read-only query (status, sizes, snapshot, whichpackage, "
+            "listinstalled) on each of several roots; repeat the option or "
+            "use a quoted glob"
+        ),
+    )
+
     subparsers = parser.add_subparsers(
         title='subcommands', help=argparse.SUPPRESS
     )
@@ -194,6 +247,21 @@ def main():
     )
     parser_autoremove.set_defaults(func=function)
 
+    function = commands.batch
+    parser_batch = subparsers.add_parser(
+        "batch",
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_batch.add_argument(
+        "script", help="file of wajig commands, or '-' for standard input"
+    )
+    parser_batch.add_argument(
+        "-m", "--merge", action="store_true",
+        help="merge consecutive install/remove/purge lines into one transaction",
+    )
+    parser_batch.set_defaults(func=function)
+
     function = commands.build
     parser_build = subparsers.add_parser(
         "build",
@@ -221,7 +289,11 @@ def main():
         description=function.__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser_changelog.add_argument("package")
+    parser_changelog.add_argument("package", nargs="?")
+    message = "show what is new in all pending upgrades"
+    parser_changelog.add_argument(
+        "--upgradable", action="store_true", help=message
+    )
     parser_changelog.set_defaults(func=function)
 
     function = commands.clean
@@ -232,13 +304,31 @@ def main():
     )
     parser_clean.set_defaults(func=function)
 
+    function = commands.conffiles
+    parser_conffiles = subparsers.add_parser(
+        "conffiles",
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_conffiles.add_argument("packages", nargs="*")
+    parser_conffiles.add_argument(
+        "--list", action="store_true",
+        help="only list the changed conffiles, without diffs"
+    )
+    parser_conffiles.set_defaults(func=function)
+
     function = commands.contents
     parser_contents = subparsers.add_parser(
         "contents",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_contents.add_argument("debfiles", nargs="+", metavar="debfile")
+    parser_contents.add_argument(
+        "--json", action="store_true",
+        help="show one JSON object per package file"
     )
-    parser_contents.add_argument("debfile")
     parser_contents.set_defaults(func=function)
 
     function = commands.dailyupgrade
@@ -264,8 +354,13 @@ def main():
         "describe",
         parents=[parser_verbose, parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_describe.add_argument("packages", nargs="+")
+    parser_describe.add_argument(
+        "--json", action="store_true",
+        help="show one JSON object per package file"
+    )
     parser_describe.set_defaults(func=function)
 
     function = commands.describenew
@@ -291,6 +386,24 @@ def main():
     help = "distribution/suite to upgrade to (e.g. unstable)"
     parser_distupgrade.set_defaults(func=function)
 
+    function = commands.docsearch
+    parser_docsearch = subparsers.add_parser(
+        "docsearch",
+        aliases=["doc-search"],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_docsearch.add_argument("words", nargs="+")
+    message = "number of documents to show (default: 20)"
+    parser_docsearch.add_argument(
+        "--limit", type=int, default=20, metavar="N", help=message
+    )
+    message = "number of matching lines to show per document (default: 5)"
+    parser_docsearch.add_argument(
+        "--lines", type=int, default=5, metavar="N", help=message
+    )
+    parser_docsearch.set_defaults(func=function)
+
     function = commands.download
     parser_download = subparsers.add_parser(
         "download",
@@ -346,6 +459,18 @@ def main():
     )
     parser_fixmissing.set_defaults(func=function)
 
+    function = commands.fleetdiff
+    parser_fleetdiff = subparsers.add_parser(
+        "fleetdiff",
+        aliases=["fleet-diff"],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_fleetdiff.add_argument(
+        "hosts", nargs="*", help="hosts to compare (default: all)"
+    )
+    parser_fleetdiff.set_defaults(func=function)
+
     function = commands.force
     parser_force = subparsers.add_parser(
         "force",
@@ -361,6 +486,7 @@ def main():
         "hold",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_hold.add_argument("packages", nargs="+")
     parser_hold.set_defaults(func=function)
@@ -370,8 +496,17 @@ def main():
         "info",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_info.add_argument("debfiles", nargs="+", metavar="debfile")
+    parser_info.add_argument(
+        "--json", action="store_true",
+        help="show one JSON object per package file"
+    )
+    parser_info.add_argument(
+        "--sha256", action="store_true",
+        help="show the sha256 checksum of each package file"
     )
-    parser_info.add_argument("package")
     parser_info.set_defaults(func=function)
 
     function = commands.init
@@ -413,6 +548,10 @@ def main():
         "integrity",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_integrity.add_argument(
+        "--json", action="store_true", help="report the problems as JSON"
     )
     parser_integrity.set_defaults(func=function)
 
@@ -420,6 +559,11 @@ def main():
     parser_large = subparsers.add_parser(
         "large",
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_large.add_argument(
+        "--closure", action="store_true",
+        help="count what removing a package frees, dependencies included",
     )
     parser_large.set_defaults(func=function)
 
@@ -465,6 +609,11 @@ def main():
         aliases=["list-cache"],
         parents=[parser_teach, parser_grep],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_listcache.add_argument(
+        "--json", action="store_true",
+        help="write one JSON object per package, then the totals",
     )
     parser_listcache.set_defaults(func=function)
 
@@ -491,8 +640,19 @@ def main():
         "listfiles",
         aliases=["list-files"],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_listfiles.add_argument("packages", nargs="+")
+    parser_listfiles.add_argument(
+        "--files-only", action="store_true", help="leave out directories"
+    )
+    parser_listfiles.add_argument(
+        "--size", action="store_true",
+        help="show the number and total size of the files of each package"
+    )
+    parser_listfiles.add_argument(
+        "--pattern", help="only show the paths matching this regular expression"
     )
-    parser_listfiles.add_argument("package")
     parser_listfiles.set_defaults(func=function)
 
     function = commands.listhold
@@ -616,7 +776,7 @@ def main():
         parents=[parser_teach],
         description=function.__doc__,
     )
-    parser_news.add_argument("package")
+    parser_news.add_argument("packages", nargs="+")
     parser_news.set_defaults(func=function)
 
     function = commands.nonfree
@@ -631,9 +791,10 @@ def main():
     function = commands.orphans
     parser_orphans = subparsers.add_parser(
         "orphans",
-        parents=[parser_teach],
+        parents=[parser_orphaned, parser_teach],
         aliases="orphaned listorphaned listorphans".split(),
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_orphans.set_defaults(func=function)
 
@@ -647,6 +808,28 @@ def main():
     parser_policy.add_argument("packages", nargs="+")
     parser_policy.set_defaults(func=function)
 
+    function = commands.prunecache
+    parser_prunecache = subparsers.add_parser(
+        "prunecache",
+        aliases=["prune-cache"],
+        parents=[parser_teach],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_prunecache.add_argument(
+        "-k", "--keep", type=count, default=2,
+        help="newest versions of each package to keep (default: 2)",
+    )
+    parser_prunecache.add_argument(
+        "--max-size", metavar="SIZE",
+        help="evict least recently used debs until the cache fits, e.g. 2G",
+    )
+    parser_prunecache.add_argument(
+        "--dry-run", action="store_true",
+        help="only report what would be deleted",
+    )
+    parser_prunecache.set_defaults(func=function)
+
     function = commands.purge
     parser_purge = subparsers.add_parser(
         "purge",
@@ -662,8 +845,9 @@ def main():
     parser_purgeorphans = subparsers.add_parser(
         "purgeorphans",
         aliases=["purge-orphans"],
-        parents=[parser_yesno],
+        parents=[parser_orphaned, parser_yesno],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_purgeorphans.set_defaults(func=function)
 
@@ -692,7 +876,7 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description=function.__doc__,
     )
-    parser_readme.add_argument("package")
+    parser_readme.add_argument("packages", nargs="+")
     parser_readme.set_defaults(func=function)
 
     function = commands.recdownload
@@ -710,6 +894,7 @@ def main():
         "recommended",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_recommended.set_defaults(func=function)
 
@@ -754,8 +939,9 @@ def main():
     parser_removeorphans = subparsers.add_parser(
         "removeorphans",
         aliases=["remove-orphans"],
-        parents=[parser_yesno],
+        parents=[parser_orphaned, parser_yesno],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_removeorphans.set_defaults(func=function)
 
@@ -779,6 +965,16 @@ def main():
     parser_reportbug.add_argument("package")
     parser_reportbug.set_defaults(func=function)
 
+    function = commands.restore
+    parser_restore = subparsers.add_parser(
+        "restore",
+        parents=[parser_yesno, parser_auth, parser_teach],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_restore.add_argument("snapshot", help="file written by SNAPSHOT")
+    parser_restore.set_defaults(func=function)
+
     function = commands.restart
     parser_restart = subparsers.add_parser(
         "restart",
@@ -788,6 +984,17 @@ def main():
     parser_restart.add_argument("daemon")
     parser_restart.set_defaults(func=function)
 
+    function = commands.rollback
+    parser_rollback = subparsers.add_parser(
+        "rollback",
+        parents=[parser_yesno, parser_auth, parser_teach],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    message = "timestamp of the transaction to undo (default: the last)"
+    parser_rollback.add_argument("timestamp", nargs="?", help=message)
+    parser_rollback.set_defaults(func=function)
+
     function = commands.rpm2deb
     parser_rpm2deb = subparsers.add_parser(
         "rpm2deb",
@@ -872,6 +1079,10 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_sizes.add_argument("packages", nargs="*")
+    parser_sizes.add_argument(
+        "--closure", action="store_true",
+        help="count what removing a package frees, dependencies included",
+    )
     parser_sizes.set_defaults(func=function)
 
     function = commands.snapshot
@@ -879,6 +1090,7 @@ def main():
         "snapshot",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_snapshot.set_defaults(func=function)
 
@@ -959,7 +1171,7 @@ def main():
         parents=[parser_teach],
         description=function.__doc__,
     )
-    parser_todo.add_argument("package")
+    parser_todo.add_argument("packages", nargs="+")
     parser_todo.set_defaults(func=function)
 
     function = commands.toupgrade
@@ -983,6 +1195,7 @@ def main():
         "unhold",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
     )
     parser_unhold.add_argument("packages", nargs="+")
     parser_unhold.set_defaults(func=function)
@@ -1058,8 +1271,12 @@ def main():
         "verify",
         parents=[parser_teach],
         description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_verify.add_argument("packages", nargs="+")
+    parser_verify.add_argument(
+        "--json", action="store_true", help="report the results as JSON"
     )
-    parser_verify.add_argument("package")
     parser_verify.set_defaults(func=function)
 
     function = commands.versions
@@ -1082,7 +1299,30 @@ def main():
     parser_whichpackage.add_argument("pattern", help="partial/full file path")
     parser_whichpackage.set_defaults(func=function)
 
-    result = parser.parse_args()
+    function = commands.why
+    parser_why = subparsers.add_parser(
+        "why",
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_why.add_argument("package")
+    parser_why.set_defaults(func=function)
+
+    function = commands.whynot
+    parser_whynot = subparsers.add_parser(
+        "whynot",
+        aliases=["why-not"],
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser_whynot.add_argument("package")
+    parser_whynot.set_defaults(func=function)
+
+    return parser
+
+
+def set_options(result):
+    """Translate parsed options into command-line fragments and flags"""
     try:
         result.recommends = "--install-recommends" if result.recommends else ""
     except AttributeError:
@@ -1118,6 +1358,38 @@ def main():
             perform.TEACH = True
     except AttributeError:
         pass
+    return result
+
+
+def main():
+
+    # without arguments, run a wajig shell (interactive mode)
+    if len(sys.argv) == 1:
+        import subprocess
+        command = "python3 /usr/share/wajig/shell.py"
+        subprocess.call(command.split())
+        return
+
+    parser = build_parser()
+    result = set_options(parser.parse_args())
+    if result.root:
+        if result.func not in ROOT_COMMANDS:
+            parser.error("--root only supports the commands: " +
+                         " ".join(f.__name__ for f in ROOT_COMMANDS))
+        try:
+            util.set_root(result.root)
+        except util.RootError as error:
+            print(error)
+            sys.exit(1)
+    if result.roots:
+        if result.func not in FAN_OUT_COMMANDS:
+            parser.error("--roots only supports the commands: " +
+                         " ".join(f.__name__ for f in FAN_OUT_COMMANDS))
+        roots = list()
+        for pattern in result.roots:
+            roots.extend(sorted(glob.glob(pattern)) or [pattern])
+        util.fan_out(roots, result)
+        return
     result.func(result)
 
 if __name__ == '__main__':
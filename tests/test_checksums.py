@@ -0,0 +1,71 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import checksums
+import util
+
+# The module globals set_root() changes.
+ROOT_STATE = (
+    "init_dir", "root_dir", "status_file", "info_dir", "dpkg_options",
+    "apt_options", "available_file", "previous_file", "new_file",
+    "snapshot_file", "file_index", "contents_index", "dep_graph",
+    "md5_cache",
+)
+
+
+class RootCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(util, name)) for name in ROOT_STATE)
+        self.directory = tempfile.mkdtemp()
+        util.init_dir = os.path.join(self.directory, "home")
+        util.md5_cache = os.path.join(util.init_dir, "Md5Cache")
+        os.makedirs(util.init_dir)
+        with open(util.md5_cache, "wb") as f:
+            f.write(b"host cache")
+        self.root = os.path.join(self.directory, "root")
+        info = os.path.join(self.root, "var/lib/dpkg/info")
+        os.makedirs(info)
+        os.makedirs(os.path.join(self.root, "etc"))
+        content = b"setting = 1\n"
+        with open(os.path.join(self.root, "etc/foo.conf"), "wb") as f:
+            f.write(content)
+        with open(os.path.join(info, "foo.md5sums"), "w") as f:
+            f.write("{}  etc/foo.conf\n".format(
+                hashlib.md5(content).hexdigest()))
+        with open(os.path.join(self.root, "var/lib/dpkg/status"), "w") as f:
+            f.write("Package: foo\nStatus: install ok installed\n"
+                    "Version: 1.0\nArchitecture: all\n\n")
+        # Keep set_root() from asking APT for the root's Available file.
+        state_dir = os.path.join(util.init_dir, "roots",
+                                 self.root.strip("/").replace("/", "_"))
+        os.makedirs(state_dir)
+        for name in ("Available", "New"):
+            open(os.path.join(state_dir, name), "w").close()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(util, name, value)
+        shutil.rmtree(self.directory)
+
+    def test_root_check_leaves_host_cache(self):
+        host_cache = util.md5_cache
+        util.set_root(self.root)
+        self.assertNotEqual(util.md5_cache, host_cache)
+        results, read = checksums.check(checksums.expected(), prune=True)
+        self.assertEqual([result[0] for result in results], [checksums.OK])
+        with open(host_cache, "rb") as f:
+            self.assertEqual(f.read(), b"host cache")
+        self.assertTrue(os.path.exists(util.md5_cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import wajig
+
+
+class CountOptionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = wajig.build_parser()
+
+    def parse(self, *arguments):
+        with open(os.devnull, "w") as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                return self.parser.parse_args(arguments)
+            finally:
+                sys.stderr = stderr
+
+    def test_prunecache_keep(self):
+        self.assertEqual(self.parse("prunecache", "--keep", "0").keep, 0)
+        self.assertEqual(self.parse("prunecache").keep, 2)
+
+    def test_prunecache_negative_keep_rejected(self):
+        with self.assertRaises(SystemExit):
+            self.parse("prunecache", "--keep", "-1")
+
+    def test_keep_backups_negative_rejected(self):
+        with self.assertRaises(SystemExit):
+            self.parse("upgrade", "--keep-backups", "-1")
+
+
+if __name__ == "__main__":
+    unittest.main()